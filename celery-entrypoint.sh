@@ -42,8 +42,8 @@ if [ "$1" = 'celery' ]; then
     set -- "$@" --concurrency "${CELERY_CONCURRENCY:-1}"
   fi
 
-  # Run under the celery user
-  set -- su-exec django "$@"
+  # Run under the celery user, with the $MALLOC_MODE allocator settings
+  set -- su-exec django with-malloc.sh "$@"
 
   # Create the Celery runtime directory at runtime in case /run is a tmpfs
   if mkdir /run/celery 2> /dev/null; then
@@ -14,52 +14,125 @@ if [ "$1" = 'celery' ]; then
 fi
 
 if [ "$1" = 'gunicorn' ]; then
-  # Do a chown of the /app/media & /app/mediafiles directories (if they exist)
-  # at runtime in case the directory was mounted as a root-owned volume.
-  for media in /app/media /app/mediafiles; do
+  # Do a chown of the /app/media, /app/mediafiles & /app/protected directories
+  # (if they exist) at runtime in case the directory was mounted as a
+  # root-owned volume.
+  for media in /app/media /app/mediafiles /app/protected; do
     if [ -d $media ] && [ "$(stat -c %U $media)" != 'django' ]; then
       chown -R django:django $media
     fi
   done
 
+  # Wait for the database and the Celery broker to accept connections, rather
+  # than exiting (and being restarted) if they're briefly unavailable
+  if [ -n "$DEPENDENCY_WAIT_TIMEOUT" ]; then
+    python -m django_bootstrap.wait
+  fi
+
   # Run the migration as the django user so that if it creates a local DB
   # (e.g. when using sqlite in development), that DB is still writable.
   # Ultimately, the user shouldn't really be using a local DB and it's difficult
   # to offer support for all the cases in which a local DB might be created --
   # but here we do the minimum.
   if [ -z "$SKIP_MIGRATIONS" ]; then
-    su-exec django django-admin migrate --noinput
+    su-exec django with-malloc.sh django-admin migrate --noinput
   fi
 
   # Allow running of collectstatic command because it might require env vars
+  if [ "$RUN_COLLECTSTATIC" = 'incremental' ]; then
+    # Only copy and post-process the files if they've changed
+    su-exec django python -m django_bootstrap.collectstatic
+  elif [ -n "$RUN_COLLECTSTATIC" ]; then
+    su-exec django with-malloc.sh django-admin collectstatic --noinput
+  fi
+  # Regenerate the map of hashed static files that Nginx caches indefinitely,
+  # as the hashes may have changed
   if [ -n "$RUN_COLLECTSTATIC" ]; then
-    su-exec django django-admin collectstatic --noinput
+    python -m django_bootstrap.static --optional
   fi
 
   if [ -n "$SUPERUSER_PASSWORD" ]; then
     echo "from django.contrib.auth.models import User
 if not User.objects.filter(username='admin').exists():
     User.objects.create_superuser('admin', 'admin@example.com', '$SUPERUSER_PASSWORD')
-" | su-exec django django-admin shell
+" | su-exec django with-malloc.sh django-admin shell
     echo "Created superuser with username 'admin' and password '$SUPERUSER_PASSWORD'"
   fi
 
+  # Create the state directory at runtime in case /run is a tmpfs. Nginx serves
+  # the state files for the /_ddb/live, /_ddb/ready and /_ddb/health health
+  # checks, which are kept up-to-date by Gunicorn.
+  mkdir -p /run/ddb/workers
+  rm -f /run/ddb/ready.json /run/ddb/health.json /run/ddb/healthy.json /run/ddb/workers/*
+  echo '{"status": "starting", "workers": 0}' > /run/ddb/state.json
+  chown -R django:django /run/ddb
+
+  # Serve ASGI apps (e.g. mysite.asgi:application) using Uvicorn workers
+  if [ -z "$GUNICORN_WORKER_PROFILE" ]; then
+    for arg in "$@" "$APP_MODULE"; do
+      if echo "$arg" | grep -Eq '^([_A-Za-z]\w*\.)*asgi:[_A-Za-z]\w*$'; then
+        export GUNICORN_WORKER_PROFILE=asgi
+      fi
+    done
+  fi
+
+  # Generate the parts of the Nginx config that depend on the container's
+  # resources, in case they've changed since the last start
+  python -m django_bootstrap.nginx /run/nginx
   nginx -g 'daemon off;' &
 
+  # Pool database connections for all the processes in the container with
+  # PgBouncer. Migrations (above) connect to the database directly.
+  if [ -n "$RUN_PGBOUNCER" ]; then
+    command -v pgbouncer > /dev/null || \
+      { echo 'RUN_PGBOUNCER is set but PgBouncer is not installed' 1>&2; exit 1; }
+    if mkdir /run/pgbouncer 2> /dev/null; then
+      chown django:django /run/pgbouncer
+      chmod 750 /run/pgbouncer
+    fi
+    DATABASE_URL="$(su-exec django python -m django_bootstrap.pgbouncer /run/pgbouncer/pgbouncer.ini)"
+    export DATABASE_URL
+    su-exec django pgbouncer /run/pgbouncer/pgbouncer.ini &
+    # Give PgBouncer a moment to start listening before anything connects
+    for _ in $(seq 50); do
+      [ -S /run/pgbouncer/.s.PGSQL.6432 ] && break
+      sleep 0.1
+    done
+  fi
+
+  # Create the Gunicorn runtime directory at runtime in case /run is a tmpfs.
+  # Celery may use it too, for the shared memory cache.
+  if mkdir /run/gunicorn 2> /dev/null; then
+    chown django:django /run/gunicorn
+  fi
+  # Don't keep cached values from before a restart
+  rm -f /run/gunicorn/django_cache
+
   # Celery
   ensure_celery_app() {
     [ -n "$CELERY_APP" ] || \
       { echo 'If $CELERY_WORKER or $CELERY_BEAT are set then $CELERY_APP must be provided'; exit 1; }
   }
 
-  if [ -n "$CELERY_WORKER" ]; then
-    ensure_celery_app
-    celery-entrypoint.sh worker --pool=solo --pidfile worker.pid &
-  fi
+  if [ -n "$SHARED_PRELOAD" ]; then
+    # The Celery processes are forked from Gunicorn's process once it has
+    # imported the Django project (see below)
+    if [ -n "$CELERY_WORKER" ] || [ -n "$CELERY_BEAT" ]; then
+      ensure_celery_app
+      if mkdir /run/celery 2> /dev/null; then
+        chown django:django /run/celery
+      fi
+    fi
+  else
+    if [ -n "$CELERY_WORKER" ]; then
+      ensure_celery_app
+      celery-entrypoint.sh worker --pool=solo --pidfile worker.pid &
+    fi
 
-  if [ -n "$CELERY_BEAT" ]; then
-    ensure_celery_app
-    celery-entrypoint.sh beat --pidfile beat.pid &
+    if [ -n "$CELERY_BEAT" ]; then
+      ensure_celery_app
+      celery-entrypoint.sh beat --pidfile beat.pid &
+    fi
   fi
 
   if [ -n "$APP_MODULE" ]; then
@@ -68,12 +141,29 @@ if not User.objects.filter(username='admin').exists():
     set -- "$@" "$APP_MODULE"
   fi
 
-  # Create the Gunicorn runtime directory at runtime in case /run is a tmpfs
-  if mkdir /run/gunicorn 2> /dev/null; then
-    chown django:django /run/gunicorn
+  # Start an arbiter, with its own workers and socket, for each named worker
+  # pool. Nginx routes the pools' URL prefixes to them (see /run/nginx/pools.conf).
+  # Options like --workers are meant for the default pool, so are removed.
+  # The pools' arbiters become children of the default pool's arbiter, which
+  # shuts down if one of them exits (see $DDB_CHILDREN in django_bootstrap.runtime).
+  for pool in $(echo "$GUNICORN_POOLS" | tr ',' ' '); do
+    GUNICORN_POOL="$pool" su-exec django with-malloc.sh \
+      python -m django_bootstrap.pools "$@" --config /etc/gunicorn/config.py &
+    DDB_CHILDREN="${DDB_CHILDREN:+$DDB_CHILDREN,}$!=Worker pool '$pool'"
+  done
+  [ -z "$DDB_CHILDREN" ] || export DDB_CHILDREN
+
+  # Import the Django project once for Gunicorn and Celery
+  if [ -n "$SHARED_PRELOAD" ]; then
+    set -- python -m django_bootstrap.preload "$@"
   fi
 
-  set -- su-exec django "$@" --config /etc/gunicorn/config.py
+  # Apply the $MALLOC_MODE allocator settings to Gunicorn, but not to Nginx
+  set -- su-exec django with-malloc.sh "$@" --config /etc/gunicorn/config.py
+fi
+
+if [ "$1" = 'django-admin' ]; then
+  set -- with-malloc.sh "$@"
 fi
 
 exec "$@"
@@ -0,0 +1,6 @@
+"""
+Helpers for Django projects run using the django-bootstrap Docker image.
+
+This package is installed in the image alongside Gunicorn. Like Gunicorn, your
+Django project should not depend on it outside of the image.
+"""
@@ -0,0 +1,355 @@
+"""
+A Django cache backend that stores entries in a memory-mapped file, so that
+all the processes in a container (Gunicorn's workers and a Celery worker run
+alongside them) share one cache. Unlike ``LocMemCache``, an entry cached by
+one worker is a cache hit in all the others. Put the file on a tmpfs (e.g.
+mount one at ``/run``) so that it's never written to disk.
+
+Configure it in your Django settings::
+
+    CACHES = {
+        "default": {
+            "BACKEND": "django_bootstrap.cache.SharedMemoryCache",
+            # Optional, the path of the file
+            "LOCATION": "/run/gunicorn/django_cache",
+            "OPTIONS": {
+                "MAX_ENTRIES": 1000,
+                "MAX_ENTRY_SIZE": 65536,
+            },
+        },
+    }
+
+The file holds a fixed number of fixed-size slots, so it uses at most
+``MAX_ENTRIES * MAX_ENTRY_SIZE`` bytes. Entries (the key and the pickled
+value) that don't fit in a slot aren't cached. Slots are grouped into sets of
+``WAYS``, and each key can only be stored in one set. When a set is full, the
+least recently used entry in it is evicted.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.core.exceptions import ImproperlyConfigured
+
+DEFAULT_LOCATION = "/run/gunicorn/django_cache"
+DEFAULT_MAX_ENTRY_SIZE = 64 * 1024
+
+MAGIC = b"DDBCACHE"
+VERSION = 1
+# The magic number, version, number of sets, ways and slot size
+HEADER = struct.Struct("<8sIIII")
+HEADER_SIZE = mmap.PAGESIZE
+# The number of slots in each set
+WAYS = 8
+# The hash of the key (0 if the slot is empty), the time the entry expires,
+# the time it was last used, and the lengths of the key and the value. The key
+# and the value follow.
+SLOT = struct.Struct("<QddII")
+
+# Django creates an instance of the backend for each thread, so the mapped
+# files and the locks for them are shared by all the instances in the process,
+# like LocMemCache's caches
+_files = {}
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _reset_locks():
+    # Locks may have been held by other threads when the process forked
+    global _locks_lock
+    _locks_lock = threading.Lock()
+    for path in _locks:
+        _locks[path] = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_locks)
+
+
+class SharedMemoryCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._path = location or DEFAULT_LOCATION
+        options = params.get("OPTIONS", {})
+        self._slot_size = int(
+            options.get("MAX_ENTRY_SIZE", DEFAULT_MAX_ENTRY_SIZE))
+        self._sets = max(1, math.ceil(self._max_entries / WAYS))
+        self._size = HEADER_SIZE + self._sets * WAYS * self._slot_size
+
+        with _locks_lock:
+            _locks.setdefault(self._path, threading.Lock())
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._make_key(key, version)
+        with self._locked_set(key) as slots:
+            if self._find(slots, key) is not None:
+                return False
+            return self._store(slots, key, value, timeout)
+
+    def get(self, key, default=None, version=None):
+        key = self._make_key(key, version)
+        with self._locked_set(key) as slots:
+            offset = self._find(slots, key)
+            if offset is None:
+                return default
+            self._touch_slot(offset)
+            return pickle.loads(self._value(offset))
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._make_key(key, version)
+        with self._locked_set(key) as slots:
+            self._store(slots, key, value, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._make_key(key, version)
+        with self._locked_set(key) as slots:
+            offset = self._find(slots, key)
+            if offset is None:
+                return False
+            self._touch_slot(offset, self._expiry(timeout))
+            return True
+
+    def delete(self, key, version=None):
+        key = self._make_key(key, version)
+        with self._locked_set(key) as slots:
+            offset = self._find(slots, key)
+            if offset is None:
+                return False
+            self._clear_slot(offset)
+            return True
+
+    def has_key(self, key, version=None):
+        key = self._make_key(key, version)
+        with self._locked_set(key) as slots:
+            return self._find(slots, key) is not None
+
+    def incr(self, key, delta=1, version=None):
+        cache_key = self._make_key(key, version)
+        with self._locked_set(cache_key) as slots:
+            offset = self._find(slots, cache_key)
+            if offset is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(self._value(offset)) + delta
+            _, expires, _, _, _ = SLOT.unpack_from(self._mmap, offset)
+            # Keep the expiry time rather than resetting the timeout
+            if not self._write_slot(offset, cache_key, value, expires):
+                # Don't leave the old value around for the key
+                self._clear_slot(offset)
+                raise ValueError(
+                    "Key '%s' can't be stored after incrementing, as it's "
+                    "too large" % key)
+            return value
+
+    def clear(self):
+        with self._locked(0, 0) as mm:
+            for offset in range(HEADER_SIZE, self._size, self._slot_size):
+                SLOT.pack_into(mm, offset, 0, 0, 0, 0, 0)
+
+    def close(self, **kwargs):
+        # Keep the file mapped between requests
+        pass
+
+    def _make_key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _expiry(self, timeout):
+        expiry = self.get_backend_timeout(timeout)
+        return math.inf if expiry is None else expiry
+
+    @property
+    def _mmap(self):
+        return _files[self._path][1]
+
+    def _open(self):
+        # Called with the lock for the path held
+        if self._path in _files:
+            return _files[self._path]
+
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o660)
+        try:
+            # Only one process initialises the file
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                self._initialise(fd)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            mm = mmap.mmap(fd, self._size)
+        except Exception:
+            os.close(fd)
+            raise
+        _files[self._path] = fd, mm
+        return fd, mm
+
+    def _initialise(self, fd):
+        header = HEADER.pack(
+            MAGIC, VERSION, self._sets, WAYS, self._slot_size)
+        size = os.fstat(fd).st_size
+        existing = os.pread(fd, HEADER.size, 0)
+        if size == self._size and existing == header:
+            return
+        # Processes only map the file once it has a header, so a file without
+        # one isn't in use yet. Never resize a file that's in use: processes
+        # that have it mapped would crash or read the slots wrongly.
+        if size not in (0, self._size) or existing.strip(b"\0"):
+            raise ImproperlyConfigured(
+                "The shared memory cache file at '{}' was created with "
+                "different MAX_ENTRIES or MAX_ENTRY_SIZE options (or by a "
+                "different version of the backend). Use a different LOCATION "
+                "for each configuration, or remove the file when no "
+                "processes are using it.".format(self._path))
+        os.ftruncate(fd, self._size)
+        os.pwrite(fd, header, 0)
+
+    def _locked(self, start, length):
+        return _Locked(self, start, length)
+
+    def _locked_set(self, key):
+        key_hash = _hash(key)
+        set_size = WAYS * self._slot_size
+        start = HEADER_SIZE + (key_hash % self._sets) * set_size
+        return _LockedSet(self, start, set_size, key_hash)
+
+    def _slots(self, start):
+        return range(start, start + WAYS * self._slot_size, self._slot_size)
+
+    def _find(self, slots, key):
+        mm = self._mmap
+        key_hash, start = slots
+        key_bytes = key.encode()
+        now = time.time()
+        for offset in self._slots(start):
+            slot_hash, expires, _, key_length, _ = SLOT.unpack_from(
+                mm, offset)
+            if slot_hash != key_hash:
+                continue
+            key_start = offset + SLOT.size
+            if mm[key_start:key_start + key_length] != key_bytes:
+                continue
+            if expires <= now:
+                self._clear_slot(offset)
+                return None
+            return offset
+        return None
+
+    def _store(self, slots, key, value, timeout):
+        key_hash, start = slots
+        # Replace the existing entry, or use an empty or expired slot, or
+        # evict the least recently used entry
+        offset = self._find(slots, key)
+        if offset is None:
+            now = time.time()
+            candidates = []
+            for slot in self._slots(start):
+                slot_hash, expires, used, _, _ = SLOT.unpack_from(
+                    self._mmap, slot)
+                if slot_hash == 0 or expires <= now:
+                    offset = slot
+                    break
+                candidates.append((used, slot))
+            else:
+                _, offset = min(candidates)
+
+        if not self._write_slot(offset, key, value, self._expiry(timeout)):
+            # Don't leave the old value around for the key
+            if SLOT.unpack_from(self._mmap, offset)[0] == key_hash:
+                self._clear_slot(offset)
+            return False
+        return True
+
+    def _write_slot(self, offset, key, value, expires):
+        key_bytes = key.encode()
+        value_bytes = pickle.dumps(value, self.pickle_protocol)
+        end = offset + SLOT.size + len(key_bytes) + len(value_bytes)
+        if end > offset + self._slot_size:
+            return False
+
+        mm = self._mmap
+        key_start = offset + SLOT.size
+        mm[key_start:key_start + len(key_bytes)] = key_bytes
+        mm[key_start + len(key_bytes):end] = value_bytes
+        SLOT.pack_into(
+            mm, offset, _hash(key), expires, time.time(), len(key_bytes),
+            len(value_bytes))
+        return True
+
+    def _value(self, offset):
+        _, _, _, key_length, value_length = SLOT.unpack_from(
+            self._mmap, offset)
+        value_start = offset + SLOT.size + key_length
+        return self._mmap[value_start:value_start + value_length]
+
+    def _touch_slot(self, offset, expires=None):
+        key_hash, old_expires, _, key_length, value_length = (
+            SLOT.unpack_from(self._mmap, offset))
+        SLOT.pack_into(
+            self._mmap, offset, key_hash,
+            old_expires if expires is None else expires, time.time(),
+            key_length, value_length)
+
+    def _clear_slot(self, offset):
+        SLOT.pack_into(self._mmap, offset, 0, 0, 0, 0, 0)
+
+
+class _Locked:
+    """
+    Lock a range of the cache file (the whole file if ``length`` is 0) for
+    the duration of a ``with`` block, and return the mapping.
+    """
+
+    def __init__(self, cache, start, length):
+        self.cache = cache
+        self.start = start
+        self.length = length
+
+    def __enter__(self):
+        # fcntl locks only exclude other processes, so threads in this
+        # process also need to take the lock for the path
+        self.lock = _locks[self.cache._path]
+        self.lock.acquire()
+        try:
+            self.fd, mm = self.cache._open()
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.length, self.start)
+        except BaseException:
+            self.lock.release()
+            raise
+        return mm
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.length, self.start)
+        finally:
+            self.lock.release()
+
+
+class _LockedSet(_Locked):
+    """
+    Lock the set of slots for a key, and return the key's hash and the offset
+    of the set.
+    """
+
+    def __init__(self, cache, start, length, key_hash):
+        super().__init__(cache, start, length)
+        self.key_hash = key_hash
+
+    def __enter__(self):
+        super().__enter__()
+        return self.key_hash, self.start
+
+
+def _hash(key):
+    # 0 marks an empty slot
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
@@ -0,0 +1,98 @@
+"""
+Work out the resources available to the container from its cgroup (v1 or v2)
+limits. Container runtimes limit CPU time with a quota, which isn't reflected
+in the number of CPUs the kernel reports.
+"""
+import math
+import os
+import re
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+NODE_ROOT = "/sys/devices/system/node"
+
+
+def _read(path):
+    with open(os.path.join(CGROUP_ROOT, path)) as f:
+        return f.read().strip()
+
+
+def cpu_quota():
+    """
+    Return the CPU quota as a (possibly fractional) number of CPUs, or
+    ``None`` if there is no quota.
+    """
+    # cgroup v2
+    try:
+        quota, period = _read("cpu.max").split()
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1
+    try:
+        quota = int(_read("cpu/cpu.cfs_quota_us"))
+        period = int(_read("cpu/cpu.cfs_period_us"))
+    except (OSError, ValueError):
+        return None
+    if quota <= 0:
+        return None
+    return quota / period
+
+
+def cpu_count():
+    """
+    Return the number of CPUs that the container can make full use of: the
+    number of CPUs it may run on, limited by its CPU quota (rounded up).
+    """
+    count = len(os.sched_getaffinity(0))
+    quota = cpu_quota()
+    if quota is not None:
+        count = min(count, max(1, math.ceil(quota)))
+    return count
+
+
+def _parse_cpu_list(cpu_list):
+    # e.g. "0-3,8-11"
+    cpus = []
+    for part in cpu_list.split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def _numa_nodes():
+    try:
+        names = os.listdir(NODE_ROOT)
+    except OSError:
+        return []
+    nodes = sorted(
+        int(name[len("node"):]) for name in names
+        if re.match(r"^node\d+$", name))
+    cpu_lists = []
+    for node in nodes:
+        path = os.path.join(NODE_ROOT, "node{}".format(node), "cpulist")
+        try:
+            with open(path) as f:
+                cpu_lists.append(_parse_cpu_list(f.read().strip()))
+        except (OSError, ValueError):
+            return []
+    return cpu_lists
+
+
+def allowed_cpus():
+    """
+    Return the CPUs that the container may run on (i.e. its cpuset), ordered
+    so that the CPUs on each NUMA node are next to each other. Processes
+    pinned to CPUs from the start of the list then share a node's caches and
+    memory before spilling over onto the next node.
+    """
+    allowed = os.sched_getaffinity(0)
+    cpus = []
+    for node_cpus in _numa_nodes():
+        cpus.extend(cpu for cpu in node_cpus if cpu in allowed)
+    cpus.extend(sorted(allowed.difference(cpus)))
+    return cpus
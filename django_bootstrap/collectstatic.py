@@ -0,0 +1,234 @@
+"""
+Collect static files like ``django-admin collectstatic --noinput``, but copy
+and hash the files using a pool of processes, and skip the work entirely if
+nothing has changed since the last run.
+
+Run by the entrypoint script when ``RUN_COLLECTSTATIC`` is ``incremental``::
+
+    python -m django_bootstrap.collectstatic
+
+The content hash of each collected file is kept in an index in
+``STATIC_ROOT``. Files whose hashes match the index aren't copied again, and
+if no files have changed (and the manifest exists) post-processing (e.g.
+``ManifestStaticFilesStorage`` renaming files with their hashes) is skipped.
+Otherwise the storage post-processes all the files as usual, but using the
+hashes already computed for the files' original contents, and the manifest is
+replaced atomically.
+
+Only storages on the local filesystem are supported. For any other storage,
+this falls back to running ``collectstatic``.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from django_bootstrap import cgroups
+
+INDEX_NAME = ".ddb-collectstatic.json"
+INDEX_VERSION = 1
+
+
+def file_hash(path):
+    # The same hash as Django's HashedFilesMixin.file_hash()
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def collect_file(source, destination, indexed_hash):
+    """
+    Copy a file if it has changed. Returns its hash and whether it was
+    copied.
+    """
+    digest = file_hash(source)
+    if digest == indexed_hash and os.path.exists(destination):
+        return digest, False
+
+    directory = os.path.dirname(destination)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp, open(source, "rb") as f:
+            shutil.copyfileobj(f, tmp)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, destination)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return digest, True
+
+
+def _collect(args):
+    return collect_file(*args)
+
+
+def find_files():
+    """
+    Return an ordered mapping of the paths of the files to collect to their
+    source storage and path, like ``collectstatic`` does.
+    """
+    from django.apps import apps
+    from django.contrib.staticfiles.finders import get_finders
+
+    ignore_patterns = apps.get_app_config("staticfiles").ignore_patterns
+    found_files = OrderedDict()
+    for finder in get_finders():
+        for path, storage in finder.list(ignore_patterns):
+            prefix = getattr(storage, "prefix", None)
+            prefixed_path = os.path.join(prefix, path) if prefix else path
+            # The first file found with a path wins
+            found_files.setdefault(prefixed_path, (storage, path))
+    return found_files
+
+
+def _local_path(storage, name):
+    try:
+        return storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def _storage_name(storage):
+    cls = type(storage)
+    return "{}.{}".format(cls.__module__, cls.__qualname__)
+
+
+def load_index(path):
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return index if index.get("version") == INDEX_VERSION else None
+
+
+def write_json_atomically(path, data):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def post_process(storage, found_files, hashes):
+    """
+    Post-process the files, using the hashes already computed for the files'
+    original contents, and replace the manifest atomically.
+    """
+    from django.core.files.base import ContentFile
+
+    file_hash = storage.file_hash
+
+    def known_file_hash(name, content=None):
+        # Adjusted content (e.g. CSS with rewritten URLs) must be hashed
+        if not isinstance(content, ContentFile) and name in hashes:
+            return hashes[name][:12]
+        return file_hash(name, content)
+
+    storage.file_hash = known_file_hash
+
+    # Write the manifest to a temporary file and then move it into place, so
+    # that the manifest is never missing or incomplete
+    manifest_name = getattr(storage, "manifest_name", None)
+    if manifest_name is not None:
+        storage.manifest_name = ".tmp-" + manifest_name
+
+    processed = 0
+    for original_path, processed_path, was_processed in storage.post_process(
+            found_files, dry_run=False):
+        if isinstance(was_processed, Exception):
+            raise was_processed
+        processed += bool(was_processed)
+
+    if manifest_name is not None:
+        manifest_storage = _manifest_storage(storage)
+        os.replace(
+            manifest_storage.path(storage.manifest_name),
+            manifest_storage.path(manifest_name))
+        storage.manifest_name = manifest_name
+    return processed
+
+
+def _manifest_storage(storage):
+    # Django 4.2+ can keep the manifest in a different storage
+    return getattr(storage, "manifest_storage", None) or storage
+
+
+def collectstatic(workers=None):
+    from django.contrib.staticfiles.storage import staticfiles_storage
+    from django.core.management import call_command
+
+    storage = staticfiles_storage
+    found_files = find_files()
+
+    sources = [
+        _local_path(source_storage, path)
+        for source_storage, path in found_files.values()]
+    destinations = [_local_path(storage, name) for name in found_files]
+    if None in sources or None in destinations:
+        print("Static files aren't all on the local filesystem, running "
+              "collectstatic")
+        call_command("collectstatic", interactive=False)
+        return
+
+    index_path = storage.path(INDEX_NAME)
+    index = load_index(index_path) or {}
+    indexed = index.get("files", {})
+    if index.get("storage") != _storage_name(storage):
+        indexed = {}
+
+    with ProcessPoolExecutor(workers or cgroups.cpu_count()) as executor:
+        results = list(executor.map(
+            _collect,
+            [(source, destination, indexed.get(name))
+             for name, source, destination in zip(
+                 found_files, sources, destinations)],
+            chunksize=32))
+
+    hashes = {
+        name: digest for name, (digest, _) in zip(found_files, results)}
+    copied = sum(copied for _, copied in results)
+
+    manifest_name = getattr(storage, "manifest_name", None)
+    unchanged = (
+        hashes == indexed and
+        (manifest_name is None or
+         _manifest_storage(storage).exists(manifest_name)))
+    if unchanged:
+        print("{} static files unchanged".format(len(hashes)))
+        return
+
+    processed = 0
+    if hasattr(storage, "post_process"):
+        processed = post_process(storage, found_files, hashes)
+
+    # Only record the files once they've been post-processed
+    write_json_atomically(index_path, {
+        "version": INDEX_VERSION,
+        "storage": _storage_name(storage),
+        "files": hashes,
+    })
+    print("{} static files copied, {} unmodified, {} post-processed".format(
+        copied, len(hashes) - copied, processed))
+
+
+def main(workers=None):
+    import django
+    django.setup()
+    collectstatic(int(workers) if workers else None)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
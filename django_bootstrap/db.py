@@ -0,0 +1,80 @@
+"""
+Database connection management for Gunicorn workers. The functions here are
+called by the Gunicorn config in the image.
+"""
+import time
+
+import django
+from django.core import signals
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+try:
+    from prometheus_client import Counter
+except ImportError:
+    Counter = None
+
+# Only check whether a persistent connection is still usable if it hasn't been
+# used for this long. Connections are most likely to be dropped (e.g. by a
+# firewall or by PostgreSQL's idle timeouts) when they're idle.
+HEALTH_CHECK_IDLE_SECONDS = 10
+
+if Counter is not None:
+    CONNECTIONS_OPENED = Counter(
+        "django_bootstrap_db_connections_opened_total",
+        "Number of database connections opened by Django",
+        ["alias", "vendor"])
+else:
+    CONNECTIONS_OPENED = None
+
+_last_request_finished = None
+
+
+def install():
+    """
+    Count connections as they are opened and, on versions of Django that
+    don't support the ``CONN_HEALTH_CHECKS`` setting, check persistent
+    connections before reusing them.
+    """
+    connection_created.connect(
+        _connection_created, dispatch_uid="django_bootstrap.db")
+
+    # Django 4.1+ does its own health checks if CONN_HEALTH_CHECKS is set
+    if django.VERSION < (4, 1):
+        # Django connects its own receivers to close old connections when
+        # django.db is imported, so these run after those.
+        signals.request_started.connect(
+            _check_connections, dispatch_uid="django_bootstrap.db")
+        signals.request_finished.connect(
+            _request_finished, dispatch_uid="django_bootstrap.db")
+
+
+def close_connections():
+    """
+    Close all of this thread's database connections.
+    """
+    for connection in connections.all():
+        connection.close()
+
+
+def _connection_created(sender, connection, **kwargs):
+    if CONNECTIONS_OPENED is not None:
+        CONNECTIONS_OPENED.labels(connection.alias, connection.vendor).inc()
+
+
+def _request_finished(**kwargs):
+    global _last_request_finished
+    _last_request_finished = time.monotonic()
+
+
+def _check_connections(**kwargs):
+    if (_last_request_finished is not None and
+            time.monotonic() - _last_request_finished <
+            HEALTH_CHECK_IDLE_SECONDS):
+        return
+
+    for connection in connections.all():
+        if (connection.connection is not None and
+                connection.settings_dict.get("CONN_HEALTH_CHECKS") and
+                not connection.is_usable()):
+            connection.close()
@@ -0,0 +1,199 @@
+"""
+Run deep health checks (e.g. that the database can be queried) in the
+background, and cache the results in files that Nginx serves for the
+``/_ddb/health`` health check, so that probes never wait on the checks or on
+a Gunicorn worker.
+
+One Gunicorn worker at a time runs the checks, in a thread started by the
+Gunicorn config in the image. The workers compete for a lock, so when the
+worker running the checks exits, another one takes over.
+
+The checks are a query on each of the project's databases, and the checks
+registered with django-health-check (e.g. ``health_check.db`` and
+``health_check.contrib.celery``) if it is installed. The database checks have
+a timeout, and Gunicorn's arbiter treats the results as unhealthy if they
+haven't been updated for a few intervals, e.g. because a check is stuck.
+"""
+import copy
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+
+from django_bootstrap.runtime import STATE_DIR, write_json
+
+LOCK_PATH = os.path.join(STATE_DIR, "health.lock")
+# The results of the last checks
+RESULTS_PATH = os.path.join(STATE_DIR, "health.json")
+# Only exists if all the checks passed
+HEALTHY_PATH = os.path.join(STATE_DIR, "healthy.json")
+
+WORKING = "working"
+
+# The longest to wait for the database, in seconds
+TIMEOUT = 5
+# Results are treated as unhealthy once they're this many intervals old
+STALE_INTERVALS = 3
+
+
+def start(interval, log):
+    """
+    Start the thread that runs the checks every ``interval`` seconds, once
+    this process holds the lock.
+    """
+    thread = threading.Thread(
+        target=_run, args=(interval, log), name="ddb-health", daemon=True)
+    thread.start()
+    return thread
+
+
+def _run(interval, log):
+    if not os.path.isdir(STATE_DIR):
+        return
+
+    with open(LOCK_PATH, "w") as lock:
+        # Poll rather than block, which would also block gevent's hub
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(interval)
+
+        log.info("Running health checks every %gs", interval)
+        while True:
+            try:
+                write_results(run_checks())
+            except Exception:
+                log.exception("Unable to run health checks")
+            time.sleep(interval)
+
+
+def run_checks():
+    """
+    Return a dict of check names to ``"working"`` or a description of the
+    error.
+    """
+    from django.db import connections
+
+    results = {}
+    try:
+        for alias in connections:
+            results["database:" + alias] = _check_database(alias)
+        results.update(_health_check_plugins())
+    finally:
+        # Don't hold connections open between checks
+        for connection in connections.all():
+            connection.close()
+    return results
+
+
+def _check_database(alias):
+    from django.db import connections
+
+    # Use a separate connection with timeouts, so that the check can't hang
+    try:
+        connection = connections[alias].copy()
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+    _set_timeouts(connection.settings_dict, connection.vendor)
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # SET LOCAL only lasts until the end of the transaction, so
+                # doesn't affect other clients of PgBouncer's connections
+                cursor.execute("BEGIN")
+                cursor.execute(
+                    "SET LOCAL statement_timeout = %s", [TIMEOUT * 1000])
+                cursor.execute("SELECT 1")
+                cursor.execute("COMMIT")
+            else:
+                cursor.execute("SELECT 1")
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+    finally:
+        connection.close()
+    return WORKING
+
+
+def _set_timeouts(settings_dict, vendor):
+    options = settings_dict.setdefault("OPTIONS", {})
+    if vendor == "postgresql":
+        # libpq's connect_timeout is a whole number of seconds
+        options["connect_timeout"] = math.ceil(TIMEOUT)
+    elif vendor == "mysql":
+        options["connect_timeout"] = math.ceil(TIMEOUT)
+        options["read_timeout"] = math.ceil(TIMEOUT)
+    elif vendor == "sqlite":
+        options["timeout"] = TIMEOUT
+
+
+def _health_check_plugins():
+    from django.apps import apps
+    if not apps.is_installed("health_check"):
+        return {}
+    from health_check.plugins import plugin_dir
+
+    results = {}
+    for entry in plugin_dir._registry:
+        plugin_class, options = (
+            entry if isinstance(entry, tuple) else (entry, {}))
+        plugin = plugin_class(**copy.deepcopy(options))
+        try:
+            plugin.run_check()
+        except Exception as e:
+            results[plugin.identifier()] = "{}: {}".format(
+                type(e).__name__, e)
+            continue
+        results[plugin.identifier()] = (
+            WORKING if not plugin.errors else
+            "; ".join(str(error) for error in plugin.errors))
+    return results
+
+
+def write_results(results):
+    healthy = all(result == WORKING for result in results.values())
+    state = {
+        "status": "healthy" if healthy else "unhealthy",
+        "checked": int(time.time()),
+        "checks": results,
+    }
+    write_json(RESULTS_PATH, state)
+    if healthy:
+        write_json(HEALTHY_PATH, state)
+    else:
+        try:
+            os.unlink(HEALTHY_PATH)
+        except FileNotFoundError:
+            pass
+
+
+def expire(interval, log):
+    """
+    Treat the results as unhealthy if the checks haven't finished for a few
+    intervals, e.g. because a check or the worker running them is stuck.
+    Called by Gunicorn's arbiter about once a second.
+    """
+    try:
+        age = time.time() - os.stat(HEALTHY_PATH).st_mtime
+    except FileNotFoundError:
+        return
+    if age <= interval * STALE_INTERVALS + TIMEOUT:
+        return
+
+    try:
+        with open(RESULTS_PATH) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    state["status"] = "stale"
+    write_json(RESULTS_PATH, state)
+    try:
+        os.unlink(HEALTHY_PATH)
+    except FileNotFoundError:
+        return
+    log.warning(
+        "Health checks haven't finished for %.0fs, so treating them as "
+        "unhealthy", age)
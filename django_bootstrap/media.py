@@ -0,0 +1,114 @@
+"""
+Serve protected media files using Nginx's ``X-Accel-Redirect`` header. A view
+checks whether the user may download a file and returns a response from
+:func:`protected_media_response`. Nginx then sends the file itself, so the
+Gunicorn worker is free to handle another request as soon as the view
+returns.
+
+Protected files are stored under ``/app/protected``, which Nginx only serves
+in response to an ``X-Accel-Redirect`` header.
+
+Nginx can also resize and crop (public) media images itself, when
+``NGINX_MEDIA_RESIZE_SECRET`` is set. :func:`resized_media_url` returns the
+signed URL for a resized image.
+"""
+import base64
+import hashlib
+import mimetypes
+import os
+import posixpath
+from urllib.parse import quote
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+
+PROTECTED_MEDIA_ROOT = "/app/protected"
+# Must match the internal location in locations/protected.conf
+PROTECTED_MEDIA_URL = "/_ddb/protected/"
+# Must match the location in the config generated by django_bootstrap.nginx
+RESIZED_MEDIA_URL = "/media-resized/"
+
+
+def protected_media_response(name, content_type=None, as_attachment=False,
+                             filename=None):
+    """
+    Return a response that tells Nginx to send a protected media file.
+
+    :param name:
+        The path of the file, relative to ``PROTECTED_MEDIA_ROOT``. If the
+        file is stored using a ``FileSystemStorage`` with that location, this
+        is the ``name`` of the file field.
+    :param content_type:
+        The content type of the response. By default this is guessed from the
+        file name.
+    :param as_attachment:
+        Whether the browser should download the file rather than display it.
+    :param filename:
+        The file name to suggest to the browser. By default this is the base
+        name of the file.
+    """
+    path = _relative_path(name, "protected media")
+
+    if content_type is None:
+        content_type, encoding = mimetypes.guess_type(path)
+        # Nginx would send the compressed file with the wrong content type
+        if content_type is None or encoding is not None:
+            content_type = "application/octet-stream"
+
+    # Nginx replaces the (empty) body of the response with the file but keeps
+    # the Content-Type, Content-Disposition, and Cache-Control headers
+    response = HttpResponse(content_type=content_type)
+    response["X-Accel-Redirect"] = PROTECTED_MEDIA_URL + quote(path)
+    patch_cache_control(response, private=True)
+
+    if as_attachment or filename:
+        response["Content-Disposition"] = _content_disposition(
+            filename or posixpath.basename(path), as_attachment)
+
+    return response
+
+
+def resized_media_url(name, width=None, height=None, crop=False):
+    """
+    Return the URL for Nginx to send a media image resized to fit within
+    ``width`` and ``height``, keeping its aspect ratio. If ``crop`` is true,
+    the image is resized to fill the size and then cropped to it. One of the
+    dimensions may be ``None``.
+
+    :param name:
+        The path of the image, relative to ``MEDIA_ROOT`` (``/app/media``),
+        i.e. the ``name`` of the image field.
+    """
+    if width is None and height is None:
+        raise ValueError("At least one of width and height must be given")
+    path = "{}{}/{}x{}/{}".format(
+        RESIZED_MEDIA_URL, "crop" if crop else "resize",
+        "-" if width is None else int(width),
+        "-" if height is None else int(height),
+        _relative_path(name, "media"))
+
+    # The same signature as Nginx's secure_link_md5 "$uri $secret"
+    secret = os.environ["NGINX_MEDIA_RESIZE_SECRET"]
+    digest = hashlib.md5("{} {}".format(path, secret).encode()).digest()
+    signature = base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+    return "{}?s={}".format(quote(path), signature)
+
+
+def _relative_path(name, kind):
+    path = posixpath.normpath(name)
+    if (posixpath.isabs(path) or path == "." or path == ".." or
+            path.startswith("../")):
+        raise SuspiciousFileOperation(
+            "The {} path '{}' is not valid".format(kind, name))
+    return path
+
+
+def _content_disposition(filename, as_attachment):
+    disposition = "attachment" if as_attachment else "inline"
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        return "{}; filename*=utf-8''{}".format(disposition, quote(filename))
+    return '{}; filename="{}"'.format(
+        disposition, filename.replace("\\", "\\\\").replace('"', '\\"'))
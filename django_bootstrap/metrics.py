@@ -0,0 +1,95 @@
+"""
+Keep the Prometheus client's multiprocess mode from growing without bound.
+The functions here are called by the Gunicorn config in the image.
+
+In multiprocess mode, each process writes a value for every combination of
+label values of every metric to its own files, and each scrape reads all the
+files. So a label with many values (e.g. a path or an ID) multiplies the size
+of the files and of the scrapes by the number of workers.
+"""
+import glob
+import logging
+import os
+import threading
+
+from prometheus_client import Counter, multiprocess
+from prometheus_client.metrics import MetricWrapperBase
+
+OTHER = "other"
+
+logger = logging.getLogger(__name__)
+
+LABELS_TRUNCATED = Counter(
+    "django_bootstrap_metric_labels_truncated_total",
+    "Number of times a label value was replaced with 'other' because the "
+    "label already had $PROMETHEUS_MAX_LABEL_VALUES values",
+    ["metric", "label"])
+
+_original_labels = MetricWrapperBase.labels
+_max_values = None
+# The label values seen in this process, for each metric and label name
+_seen = {}
+_lock = threading.Lock()
+
+
+def install(max_values):
+    """
+    Limit the number of values of each label of each metric in this process
+    (and processes forked from it). Further values are replaced with
+    ``"other"``.
+    """
+    global _max_values
+    _max_values = max_values
+    MetricWrapperBase.labels = _labels
+
+
+def _labels(self, *labelvalues, **labelkwargs):
+    names = self._labelnames
+    if labelkwargs and not labelvalues and sorted(labelkwargs) == sorted(
+            names):
+        labelvalues = tuple(labelkwargs[name] for name in names)
+    elif labelkwargs or len(labelvalues) != len(names) or self is (
+            LABELS_TRUNCATED):
+        # Let the client raise the usual errors
+        return _original_labels(self, *labelvalues, **labelkwargs)
+
+    values = tuple(
+        _limit(self._name, name, str(value))
+        for name, value in zip(names, labelvalues))
+    return _original_labels(self, *values)
+
+
+def _limit(metric, label, value):
+    with _lock:
+        seen = _seen.setdefault((metric, label), set())
+        if value in seen:
+            return value
+        if len(seen) < _max_values:
+            seen.add(value)
+            return value
+        first = OTHER not in seen
+        seen.add(OTHER)
+
+    if first:
+        logger.warning(
+            "Metric '%s' has more than %s values for label '%s', counting "
+            "further values as '%s'", metric, _max_values, label, OTHER)
+    LABELS_TRUNCATED.labels(metric, label).inc()
+    return OTHER
+
+
+def mark_process_dead(pid, path=None):
+    """
+    Remove the values of gauges that only apply to live processes, like the
+    Prometheus client does, and also the values of gauges that are reported
+    for each process (with a ``pid`` label), so that processes that have been
+    replaced don't add to every scrape forever. Counters and histograms are
+    kept, so that their totals never go down.
+    """
+    if path is None:
+        path = os.environ.get(
+            "PROMETHEUS_MULTIPROC_DIR",
+            os.environ.get("prometheus_multiproc_dir"))
+    multiprocess.mark_process_dead(pid, path)
+    for f in glob.glob(os.path.join(path, "gauge_all_{}.db".format(pid))):
+        os.remove(f)
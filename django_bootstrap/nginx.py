@@ -0,0 +1,491 @@
+"""
+Generate the parts of the Nginx config that depend on the container's
+resources or on environment variables. Run by the entrypoint script before
+starting Nginx::
+
+    python -m django_bootstrap.nginx /run/nginx
+"""
+import os
+import re
+import resource
+import sys
+
+from django_bootstrap import cgroups, pools
+
+# Cap the defaults so that huge file descriptor limits don't lead to huge
+# allocations for connection structures in each Nginx worker
+MAX_RLIMIT_NOFILE = 65536
+MAX_WORKER_CONNECTIONS = 8192
+
+# Idle connections to Gunicorn to keep open in each Nginx worker, when Gunicorn
+# supports keepalive
+DEFAULT_UPSTREAM_KEEPALIVE = 32
+
+# Buffer sizes for requests and proxied responses. Request bodies and
+# responses that don't fit in the buffers are written to temporary files in
+# /run/nginx. The buffers are only allocated as needed.
+BUFFER_PROFILES = {
+    # Nginx's defaults
+    "small": {
+        "client_body_buffer_size": "16k",
+        "proxy_buffer_size": "4k",
+        "proxy_buffers": "8 4k",
+        "proxy_busy_buffers_size": "8k",
+    },
+    # Up to 64k requests and 256k responses in memory
+    "default": {
+        "client_body_buffer_size": "64k",
+        "proxy_buffer_size": "8k",
+        "proxy_buffers": "32 8k",
+        "proxy_busy_buffers_size": "16k",
+    },
+    # Up to 1m requests and responses in memory
+    "large": {
+        "client_body_buffer_size": "1m",
+        "proxy_buffer_size": "16k",
+        "proxy_buffers": "64 16k",
+        "proxy_busy_buffers_size": "64k",
+    },
+}
+
+# Default paths for the TLS certificate and key, e.g. mounted from a volume
+TLS_CERTIFICATE = "/etc/nginx/certs/tls.crt"
+TLS_CERTIFICATE_KEY = "/etc/nginx/certs/tls.key"
+
+TLS_TEMPLATE = """\
+ssl_certificate {certificate};
+ssl_certificate_key {certificate_key};
+include conf.d/django.conf.d/tls.conf;
+
+# Nginx terminates TLS itself, so the client's X-Forwarded-Proto header can't
+# be trusted
+set $forwarded_proto $scheme;
+"""
+
+# Log a percentage of requests with 2xx responses, chosen at random
+ACCESS_LOG_SAMPLE_TEMPLATE = """\
+split_clients "$request_id" $access_log_sampled {{
+    {percent:g}% 1;
+    * 0;
+}}
+"""
+ACCESS_LOG_STATUS_TEMPLATE = """\
+map $status $access_log_status {{
+    ~^2 {sampled};
+    default 1;
+}}
+"""
+ACCESS_LOG_PATHS_TEMPLATE = """\
+map $uri $access_log_path {{
+{entries}    default {default};
+}}
+"""
+
+STREAMING_LOCATION_TEMPLATE = """\
+# Stream request bodies to Gunicorn as they are received rather than buffering
+# them first. The Gunicorn worker is occupied for the whole upload.
+location {prefix} {{
+    client_max_body_size {max_body_size};
+    proxy_request_buffering off;
+    include conf.d/django.conf.d/proxy.conf;
+}}
+"""
+
+POOL_UPSTREAM_TEMPLATE = """\
+upstream {upstream} {{
+    server unix:{socket} max_fails=0;
+    include /run/nginx/upstream_keepalive.conf;
+}}
+"""
+POOLS_MAP_TEMPLATE = """\
+# The upstream for each request, chosen by the longest matching URL prefix
+map $uri $gunicorn_upstream {{
+{entries}    default gunicorn;
+}}
+"""
+
+# Resized media images are cached on disk, by default in a volume that the
+# Debian Nginx packages create
+MEDIA_RESIZE_CACHE_PATH = "/var/cache/nginx/media_resized"
+MEDIA_RESIZE_SOCKET = "/run/nginx/media_resize.sock"
+# Checked for at runtime, as custom images may leave it out
+IMAGE_FILTER_MODULE = "/etc/nginx/modules/ngx_http_image_filter_module.so"
+MEDIA_RESIZE_SECRET_RE = re.compile(r"^[A-Za-z0-9_.~+/=-]+$")
+
+MEDIA_RESIZE_TEMPLATE = """\
+proxy_cache_path {cache_path} levels=1:2 keys_zone=media_resized:10m
+                 max_size={cache_size} inactive=30d use_temp_path=off;
+
+# Resizes media images for the /media-resized/ location, which caches the
+# results. Only Nginx itself connects to this server.
+server {{
+    listen unix:{socket};
+    access_log off;
+    root /app;
+
+    image_filter_buffer {buffer};
+
+    location ~ ^/resize/(?<width>[0-9]+|-)x(?<height>[0-9]+|-)/(?<name>.+)$ {{
+        image_filter resize $width $height;
+        try_files /media/$name /mediafiles/$name =404;
+    }}
+
+    location ~ ^/crop/(?<width>[0-9]+|-)x(?<height>[0-9]+|-)/(?<name>.+)$ {{
+        image_filter crop $width $height;
+        try_files /media/$name /mediafiles/$name =404;
+    }}
+}}
+"""
+MEDIA_RESIZE_LOCATION_TEMPLATE = """\
+# Resized media images, e.g. /media-resized/resize/200x-/photos/cat.jpg?s=...
+# The signature (see django_bootstrap.media.resized_media_url) stops clients
+# from having images resized to arbitrary sizes. Each size of each image is
+# only resized once, and then served from the cache.
+location /media-resized/ {{
+    secure_link $arg_s;
+    secure_link_md5 "$uri {secret}";
+    if ($secure_link = "") {{
+        return 403;
+    }}
+
+    # Strip the /media-resized prefix
+    proxy_pass http://unix:{socket}:/;
+    proxy_cache media_resized;
+    proxy_cache_key $uri;
+    proxy_cache_lock on;
+    proxy_cache_valid 200 30d;
+    proxy_cache_valid any 1m;
+    add_header X-Cache-Status $upstream_cache_status;
+}}
+"""
+
+
+def _env_on(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return value.lower() in ("on", "1", "true", "yes")
+
+
+def worker_processes():
+    return int(
+        os.environ.get("NGINX_WORKER_PROCESSES") or cgroups.cpu_count())
+
+
+def worker_rlimit_nofile():
+    if os.environ.get("NGINX_WORKER_RLIMIT_NOFILE"):
+        return int(os.environ["NGINX_WORKER_RLIMIT_NOFILE"])
+
+    # The Nginx master runs as root but can't raise the limit beyond the hard
+    # limit without CAP_SYS_RESOURCE, which containers usually don't have.
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        return MAX_RLIMIT_NOFILE
+    return min(hard, MAX_RLIMIT_NOFILE)
+
+
+def worker_connections(rlimit_nofile):
+    if os.environ.get("NGINX_WORKER_CONNECTIONS"):
+        return int(os.environ["NGINX_WORKER_CONNECTIONS"])
+
+    # Each proxied connection uses 2 file descriptors: one for the client and
+    # one for the upstream
+    return min(rlimit_nofile // 2, MAX_WORKER_CONNECTIONS)
+
+
+def worker_cpu_affinity(processes):
+    """
+    Return the CPU masks to pin each worker to its own CPU, or ``None`` if
+    there aren't enough CPUs.
+    """
+    # Take CPUs from the end of the list, as Gunicorn's workers take them
+    # from the start (see gunicorn/config.py)
+    cpus = cgroups.allowed_cpus()
+    if len(cpus) < max(2, processes):
+        return None
+    width = max(cpus) + 1
+    return " ".join(
+        format(1 << cpu, "0{}b".format(width))
+        for cpu in reversed(cpus[-processes:]))
+
+
+def main_config():
+    processes = worker_processes()
+    config = (
+        "worker_processes {};\n"
+        "worker_rlimit_nofile {};\n"
+    ).format(processes, worker_rlimit_nofile())
+
+    if _env_on("NGINX_CPU_AFFINITY", False):
+        masks = worker_cpu_affinity(processes)
+        if masks is not None:
+            config += "worker_cpu_affinity {};\n".format(masks)
+        else:
+            config += "# Not enough CPUs to pin each worker to its own\n"
+
+    if _media_resize_secret() is not None:
+        config += "load_module {};\n".format(IMAGE_FILTER_MODULE)
+    return config
+
+
+def events_config():
+    return (
+        "worker_connections {};\n"
+        "multi_accept {};\n"
+    ).format(
+        worker_connections(worker_rlimit_nofile()),
+        "on" if _env_on("NGINX_MULTI_ACCEPT", False) else "off")
+
+
+def listen_config():
+    # With multiple workers, have the kernel distribute connections between
+    # them rather than all the workers competing to accept each connection
+    reuseport = _env_on("NGINX_REUSEPORT", worker_processes() > 1)
+    options = " reuseport" if reuseport else ""
+    config = "listen 8000{};\n".format(options)
+    if _env_on("NGINX_TLS", False):
+        config += "listen 8443 ssl http2{};\n".format(options)
+    return config
+
+
+def tls_config():
+    if not _env_on("NGINX_TLS", False):
+        # Trust the X-Forwarded-Proto header from the load balancer in front
+        # of us
+        return "set $forwarded_proto $http_x_forwarded_proto;\n"
+
+    certificate = os.environ.get("NGINX_TLS_CERTIFICATE", TLS_CERTIFICATE)
+    certificate_key = os.environ.get(
+        "NGINX_TLS_CERTIFICATE_KEY", TLS_CERTIFICATE_KEY)
+    for path in (certificate, certificate_key):
+        if not os.path.isfile(path):
+            raise ValueError(
+                "TLS is enabled but '{}' does not exist".format(path))
+    return TLS_TEMPLATE.format(
+        certificate=certificate, certificate_key=certificate_key)
+
+
+def buffers_config():
+    profile = os.environ.get("NGINX_BUFFER_PROFILE", "default")
+    try:
+        directives = BUFFER_PROFILES[profile]
+    except KeyError:
+        raise ValueError(
+            "Unknown $NGINX_BUFFER_PROFILE '{}', must be one of: {}".format(
+                profile, ", ".join(sorted(BUFFER_PROFILES))))
+    return "".join(
+        "{} {};\n".format(name, value) for name, value in directives.items())
+
+
+def _gunicorn_keepalive():
+    # Only Gunicorn's sync workers close the connection after every request
+    return os.environ.get("GUNICORN_WORKER_PROFILE", "sync") != "sync"
+
+
+def upstream_keepalive_config():
+    if not _gunicorn_keepalive():
+        return "# Gunicorn closes connections after each request\n"
+    # Keep up to this many idle connections to Gunicorn open in each worker
+    return "keepalive {};\n".format(
+        int(os.environ.get("NGINX_UPSTREAM_KEEPALIVE") or
+            DEFAULT_UPSTREAM_KEEPALIVE))
+
+
+def proxy_keepalive_config():
+    if not _gunicorn_keepalive():
+        return "# Gunicorn closes connections after each request\n"
+    # Keepalive connections to upstreams (and WebSockets) require HTTP/1.1.
+    # The Connection header is set in proxy.conf.
+    return "proxy_http_version 1.1;\n"
+
+
+def static_config():
+    config = "# Extra config for the static files location\n"
+    # Clients never revalidate immutable files, so there's no need to send
+    # validators for them
+    if not _env_on("NGINX_STATIC_IMMUTABLE_VALIDATORS", True):
+        config += (
+            "add_header ETag $static_etag;\n"
+            "add_header Last-Modified $static_last_modified;\n"
+        )
+    if not _env_on("NGINX_STATIC_ACCESS_LOG", True):
+        config += "access_log off;\n"
+    return config
+
+
+def access_log_config():
+    if not _env_on("NGINX_ACCESS_LOG", True):
+        return "access_log off;\n"
+
+    config = ""
+    params = ["/dev/stdout", "main"]
+
+    buffer_size = os.environ.get("NGINX_ACCESS_LOG_BUFFER")
+    if buffer_size:
+        params.append("buffer=" + buffer_size)
+        params.append(
+            "flush=" + os.environ.get("NGINX_ACCESS_LOG_FLUSH", "5s"))
+
+    # Build up a chain of variables that decide whether to log each request
+    enabled = None
+
+    sample = os.environ.get("NGINX_ACCESS_LOG_SAMPLE_2XX")
+    if sample:
+        try:
+            percent = float(sample)
+        except ValueError:
+            percent = -1
+        if not 0 <= percent <= 100:
+            raise ValueError(
+                "$NGINX_ACCESS_LOG_SAMPLE_2XX must be a percentage")
+        # split_clients supports up to 2 decimal places
+        percent = round(percent, 2)
+        if percent < 100:
+            if percent > 0:
+                config += ACCESS_LOG_SAMPLE_TEMPLATE.format(percent=percent)
+                sampled = "$access_log_sampled"
+            else:
+                sampled = "0"
+            config += ACCESS_LOG_STATUS_TEMPLATE.format(sampled=sampled)
+            enabled = "$access_log_status"
+
+    skip_paths = [
+        p for p in os.environ.get("NGINX_ACCESS_LOG_SKIP_PATHS", "").split(",")
+        if p]
+    if skip_paths:
+        entries = ""
+        for path in skip_paths:
+            if not path.startswith("/"):
+                raise ValueError(
+                    "$NGINX_ACCESS_LOG_SKIP_PATHS must be paths starting "
+                    "with '/'")
+            entries += '    "~^{}" 0;\n'.format(re.escape(path))
+        config += ACCESS_LOG_PATHS_TEMPLATE.format(
+            entries=entries, default=enabled or "1")
+        enabled = "$access_log_path"
+
+    if enabled is not None:
+        params.append("if=" + enabled)
+    return config + "access_log {};\n".format(" ".join(params))
+
+
+def pools_config():
+    """
+    Return the upstreams for the Gunicorn worker pools, and a map from URL
+    prefixes to the upstream that proxy.conf passes requests to.
+    """
+    config = ""
+    prefixes = []
+    for pool in pools.pools():
+        config += POOL_UPSTREAM_TEMPLATE.format(
+            upstream=pools.upstream_name(pool.name),
+            socket=pools.socket_path(pool.name))
+        prefixes += [
+            (prefix, pools.upstream_name(pool.name))
+            for prefix in pool.prefixes]
+
+    # Regular expressions in maps are checked in order, so check the longest
+    # (most specific) prefixes first
+    prefixes.sort(key=lambda entry: len(entry[0]), reverse=True)
+    entries = "".join(
+        '    "~^{}" {};\n'.format(re.escape(prefix), upstream)
+        for prefix, upstream in prefixes)
+    return config + POOLS_MAP_TEMPLATE.format(entries=entries)
+
+
+def _media_resize_secret():
+    secret = os.environ.get("NGINX_MEDIA_RESIZE_SECRET")
+    if not secret:
+        return None
+    # The secret is included in the config as is
+    if not MEDIA_RESIZE_SECRET_RE.match(secret):
+        raise ValueError(
+            "$NGINX_MEDIA_RESIZE_SECRET may only contain letters, numbers and "
+            "the characters _.~+/=-")
+    if not os.path.exists(IMAGE_FILTER_MODULE):
+        raise ValueError(
+            "$NGINX_MEDIA_RESIZE_SECRET is set but Nginx's image filter "
+            "module isn't installed")
+    return secret
+
+
+def media_resize_config():
+    if _media_resize_secret() is None:
+        return "# Media images aren't resized\n"
+    return MEDIA_RESIZE_TEMPLATE.format(
+        cache_path=os.environ.get(
+            "NGINX_MEDIA_RESIZE_CACHE_PATH", MEDIA_RESIZE_CACHE_PATH),
+        cache_size=os.environ.get("NGINX_MEDIA_RESIZE_CACHE_SIZE", "1g"),
+        buffer=os.environ.get("NGINX_MEDIA_RESIZE_BUFFER", "10m"),
+        socket=MEDIA_RESIZE_SOCKET)
+
+
+def location_configs():
+    """
+    Return a dict of file names to config for extra server locations.
+    """
+    locations = {}
+
+    prefix = os.environ.get("NGINX_STREAMING_UPLOAD_PREFIX")
+    if prefix:
+        if not prefix.startswith("/"):
+            raise ValueError(
+                "$NGINX_STREAMING_UPLOAD_PREFIX must start with '/'")
+        locations["streaming.conf"] = STREAMING_LOCATION_TEMPLATE.format(
+            prefix=prefix,
+            max_body_size=os.environ.get(
+                "NGINX_STREAMING_UPLOAD_MAX_BODY_SIZE", "1g"))
+
+    secret = _media_resize_secret()
+    if secret is not None:
+        locations["media_resized.conf"] = (
+            MEDIA_RESIZE_LOCATION_TEMPLATE.format(
+                secret=secret, socket=MEDIA_RESIZE_SOCKET))
+
+    return locations
+
+
+def _write_configs(config_dir, configs):
+    os.makedirs(config_dir, exist_ok=True)
+    for name, config in configs.items():
+        with open(os.path.join(config_dir, name), "w") as f:
+            f.write(config)
+
+
+def main(config_dir):
+    try:
+        configs = {
+            "main.conf": main_config(),
+            "access_log.conf": access_log_config(),
+            "events.conf": events_config(),
+            "listen.conf": listen_config(),
+            "tls.conf": tls_config(),
+            "buffers.conf": buffers_config(),
+            "upstream_keepalive.conf": upstream_keepalive_config(),
+            "proxy_keepalive.conf": proxy_keepalive_config(),
+            "static.conf": static_config(),
+            "pools.conf": pools_config(),
+            "media_resize.conf": media_resize_config(),
+        }
+        locations = location_configs()
+    except ValueError as e:
+        sys.exit(str(e))
+
+    _write_configs(config_dir, configs)
+
+    # Nginx can't listen on a socket left behind if it didn't exit cleanly
+    try:
+        os.unlink(MEDIA_RESIZE_SOCKET)
+    except FileNotFoundError:
+        pass
+
+    # Remove locations from previous runs in case /run isn't a tmpfs
+    locations_dir = os.path.join(config_dir, "locations")
+    if os.path.isdir(locations_dir):
+        for name in os.listdir(locations_dir):
+            os.unlink(os.path.join(locations_dir, name))
+    _write_configs(locations_dir, locations)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
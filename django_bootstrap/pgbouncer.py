@@ -0,0 +1,117 @@
+"""
+Generate a PgBouncer config for pooling the connections to the database given
+by the ``DATABASE_URL`` environment variable, and print a new database URL for
+connecting to PgBouncer rather than the database directly.
+
+Run by the entrypoint script when ``RUN_PGBOUNCER`` is set::
+
+    python -m django_bootstrap.pgbouncer /run/pgbouncer/pgbouncer.ini
+"""
+import os
+import sys
+from urllib.parse import parse_qsl, quote, unquote, urlencode, urlsplit
+
+SOCKET_DIR = "/run/pgbouncer"
+PORT = 6432
+
+POSTGRES_SCHEMES = ("postgres", "postgresql", "pgsql", "postgis")
+
+CONFIG_TEMPLATE = """\
+[databases]
+{dbname} = {connstr}
+
+[pgbouncer]
+; Only listen on a Unix socket
+listen_addr =
+listen_port = {port}
+unix_socket_dir = {socket_dir}
+unix_socket_mode = 0770
+pidfile = {socket_dir}/pgbouncer.pid
+
+; Only processes in the container can connect to the socket, and the
+; credentials for the database are in the connection string above
+auth_type = any
+
+pool_mode = transaction
+default_pool_size = {pool_size}
+max_client_conn = {max_client_conn}
+server_tls_sslmode = {sslmode}
+
+ignore_startup_parameters = extra_float_digits
+log_connections = 0
+log_disconnections = 0
+"""
+
+
+def _quote_connstr_value(value):
+    return "'{}'".format(value.replace("\\", "\\\\").replace("'", "\\'"))
+
+
+def configure(database_url, pool_size, max_client_conn):
+    """
+    Return a tuple of the PgBouncer config, and the database URL to use to
+    connect to PgBouncer.
+    """
+    url = urlsplit(database_url)
+    if url.scheme not in POSTGRES_SCHEMES:
+        raise ValueError(
+            "PgBouncer can only be used with PostgreSQL databases, not "
+            "'{}'".format(url.scheme))
+
+    dbname = unquote(url.path[1:])
+    query = parse_qsl(url.query)
+    sslmode = dict(query).get("sslmode", "prefer")
+
+    server_params = [
+        ("host", url.hostname),
+        ("port", url.port),
+        ("dbname", dbname),
+        ("user", unquote(url.username or "")),
+        ("password", unquote(url.password or "")),
+    ]
+    connstr = " ".join(
+        "{}={}".format(k, _quote_connstr_value(str(v)))
+        for k, v in server_params if v)
+
+    config = CONFIG_TEMPLATE.format(
+        dbname=dbname if dbname.isidentifier() else '"{}"'.format(dbname),
+        connstr=connstr,
+        port=PORT,
+        socket_dir=SOCKET_DIR,
+        pool_size=pool_size,
+        max_client_conn=max_client_conn,
+        sslmode=sslmode,
+    )
+
+    # Point the database URL at the socket. The host and port are passed as
+    # query parameters (and end up in the database OPTIONS) because database
+    # URL parsers don't agree on how to specify a socket path as the host.
+    netloc = url.netloc.rsplit("@", 1)[0] + "@" if "@" in url.netloc else ""
+    query = [(k, v) for k, v in query if k != "sslmode"]
+    query += [("host", SOCKET_DIR), ("port", str(PORT))]
+    pooled_url = "{}://{}/{}?{}".format(
+        url.scheme, netloc, quote(dbname), urlencode(query))
+
+    return config, pooled_url
+
+
+def main(config_path):
+    try:
+        config, pooled_url = configure(
+            os.environ["DATABASE_URL"],
+            pool_size=int(os.environ.get("PGBOUNCER_POOL_SIZE", "10")),
+            max_client_conn=int(
+                os.environ.get("PGBOUNCER_MAX_CLIENT_CONN", "100")),
+        )
+    except KeyError:
+        sys.exit("$DATABASE_URL must be set if $RUN_PGBOUNCER is set")
+    except ValueError as e:
+        sys.exit(str(e))
+
+    with open(config_path, "w") as f:
+        f.write(config)
+    print(pooled_url)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,154 @@
+"""
+Named Gunicorn worker pools. Each pool is a separate Gunicorn arbiter, with
+its own workers, listening on its own Unix socket, and Nginx passes requests
+for the pool's URL prefixes to it rather than to the default pool. This stops
+slow endpoints from occupying all the workers that handle everything else.
+
+Pools are configured using environment variables::
+
+    GUNICORN_POOLS=reports
+    GUNICORN_POOL_REPORTS_PREFIXES=/exports/,/reports/
+    GUNICORN_POOL_REPORTS_WORKERS=2
+    GUNICORN_POOL_REPORTS_TIMEOUT=120
+
+The entrypoint script starts each pool's arbiter with the same arguments as
+the default pool's::
+
+    GUNICORN_POOL=reports python -m django_bootstrap.pools gunicorn [OPTIONS]
+"""
+import os
+import re
+import shlex
+import sys
+from collections import namedtuple
+
+SOCKET_DIR = "/run/gunicorn"
+NAME_RE = re.compile(r"^[a-z][a-z0-9_]*$")
+# Gunicorn's own defaults
+DEFAULT_WORKERS = 1
+DEFAULT_TIMEOUT = 30
+
+# Gunicorn's command line options (and $GUNICORN_CMD_ARGS) take precedence
+# over its config file, so these options for the default pool are removed from
+# the pools' arguments
+POOL_OPTIONS = {
+    "-b": "--bind",
+    "-p": "--pid",
+    "-n": "--name",
+    "-t": "--timeout",
+    "-w": "--workers",
+}
+
+Pool = namedtuple("Pool", ["name", "prefixes", "workers", "timeout"])
+
+
+def socket_path(name):
+    return os.path.join(SOCKET_DIR, "{}.sock".format(name))
+
+
+def pid_path(name):
+    return os.path.join(SOCKET_DIR, "{}.pid".format(name))
+
+
+def upstream_name(name):
+    return "gunicorn_{}".format(name)
+
+
+def pool_names(environ=os.environ):
+    return [
+        name.strip() for name in environ.get("GUNICORN_POOLS", "").split(",")
+        if name.strip()]
+
+
+def pool(name, environ=os.environ):
+    """
+    Return the configuration of the named pool. Raises ``ValueError`` if the
+    configuration isn't valid.
+    """
+    if not NAME_RE.match(name) or name == "gunicorn":
+        raise ValueError(
+            "Invalid Gunicorn pool name '{}': must be lower case letters, "
+            "numbers and underscores, and not 'gunicorn'".format(name))
+
+    var_prefix = "GUNICORN_POOL_{}_".format(name.upper())
+    prefixes = [
+        prefix.strip()
+        for prefix in environ.get(var_prefix + "PREFIXES", "").split(",")
+        if prefix.strip()]
+    if not prefixes:
+        raise ValueError("${}PREFIXES must be set".format(var_prefix))
+    for prefix in prefixes:
+        if not prefix.startswith("/"):
+            raise ValueError(
+                "${}PREFIXES must all start with '/'".format(var_prefix))
+
+    try:
+        workers = int(environ.get(var_prefix + "WORKERS") or DEFAULT_WORKERS)
+        timeout = int(environ.get(var_prefix + "TIMEOUT") or DEFAULT_TIMEOUT)
+    except ValueError:
+        raise ValueError(
+            "${0}WORKERS and ${0}TIMEOUT must be integers".format(var_prefix))
+    return Pool(name, prefixes, workers, timeout)
+
+
+def pools(environ=os.environ):
+    return [pool(name, environ) for name in pool_names(environ)]
+
+
+def signal_pools(signum, log):
+    """
+    Send a signal to the arbiter of each pool, e.g. to reload the pools along
+    with the default pool.
+    """
+    for name in pool_names():
+        try:
+            with open(pid_path(name)) as f:
+                pid = int(f.read().strip())
+            os.kill(pid, signum)
+        except (OSError, ValueError):
+            log.warning(
+                "Unable to signal the '%s' worker pool", name, exc_info=True)
+
+
+def strip_pool_options(args):
+    """
+    Return the Gunicorn arguments without the options that a pool sets from
+    its own configuration.
+    """
+    stripped = []
+    args = iter(args)
+    for arg in args:
+        if arg == "--":
+            stripped.append(arg)
+            stripped.extend(args)
+            break
+        option, eq, _ = arg.partition("=")
+        if option in POOL_OPTIONS.values():
+            if not eq:
+                next(args, None)
+            continue
+        if arg[:2] in POOL_OPTIONS:
+            # e.g. "-w 4" or "-w4"
+            if len(arg) == 2:
+                next(args, None)
+            continue
+        stripped.append(arg)
+    return stripped
+
+
+def main(argv):
+    if argv[:1] != ["gunicorn"]:
+        sys.exit(
+            "Usage: GUNICORN_POOL=<name> python -m django_bootstrap.pools "
+            "gunicorn [OPTIONS] [APP_MODULE]")
+
+    cmd_args = os.environ.get("GUNICORN_CMD_ARGS")
+    if cmd_args:
+        os.environ["GUNICORN_CMD_ARGS"] = " ".join(
+            shlex.quote(arg)
+            for arg in strip_pool_options(shlex.split(cmd_args)))
+    os.execvp(argv[0], strip_pool_options(argv))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,123 @@
+"""
+Import the Django project once, then fork the Celery worker and beat
+processes from this process and run Gunicorn's arbiter in it, so that the
+Celery processes and Gunicorn's workers share the memory used by the project's
+modules (copy-on-write) rather than each importing the project separately.
+
+Run by the entrypoint script when ``SHARED_PRELOAD`` is set::
+
+    python -m django_bootstrap.preload gunicorn [OPTIONS] [APP_MODULE]
+"""
+import os
+import shutil
+import sys
+import traceback
+
+from django_bootstrap import runtime
+
+CELERY_DIR = "/run/celery"
+
+
+def load_django():
+    """
+    Set up Django and import the URLconf (and so the views), which Django
+    otherwise imports on the first request.
+    """
+    import django
+    from django.db import connections
+    from django.urls import get_resolver
+
+    django.setup()
+    get_resolver().url_patterns
+
+    # Connections must never be shared between processes
+    for connection in connections.all():
+        connection.close()
+
+
+def celery_commands(environ):
+    """
+    Return the arguments for the Celery processes to run, like the entrypoint
+    script does with ``celery-entrypoint.sh``.
+    """
+    options = []
+    if environ.get("CELERY_BROKER"):
+        options += ["--broker", environ["CELERY_BROKER"]]
+    if environ.get("CELERY_LOGLEVEL"):
+        options += ["--loglevel", environ["CELERY_LOGLEVEL"]]
+
+    commands = []
+    if environ.get("CELERY_WORKER"):
+        commands.append(
+            ["worker", "--pool=solo", "--pidfile", "worker.pid"] + options +
+            ["--concurrency", environ.get("CELERY_CONCURRENCY") or "1"])
+    if environ.get("CELERY_BEAT"):
+        commands.append(["beat", "--pidfile", "beat.pid"] + options)
+    return commands
+
+
+def fork_celery(args):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # Never return to the caller in the child
+    code = 1
+    try:
+        # Stop when Gunicorn's arbiter (the parent) exits, as the container's
+        # init process only signals the arbiter
+        runtime.stop_with_parent()
+        os.chdir(CELERY_DIR)
+
+        sys.argv = ["celery"] + args
+        from celery.__main__ import main
+        main()
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def main(argv):
+    if argv[:1] != ["gunicorn"]:
+        sys.exit(
+            "Usage: python -m django_bootstrap.preload gunicorn [OPTIONS] "
+            "[APP_MODULE]")
+    # The gevent worker profile patches the standard library when Gunicorn
+    # loads its config, which must happen before Django is imported
+    if os.environ.get("GUNICORN_WORKER_PROFILE") == "gevent":
+        sys.exit("SHARED_PRELOAD can't be used with the gevent worker profile")
+
+    # The Prometheus client chooses whether to use multiprocess mode when it is
+    # first imported (e.g. by django-prometheus), so set it up for Gunicorn's
+    # workers before Django is imported, rather than in the Gunicorn config
+    try:
+        runtime.prometheus_multiproc_dir()
+    except OSError as e:
+        print("Unable to create prometheus_multiproc_dir directory: {}".format(
+            e), file=sys.stderr)
+
+    if "DJANGO_SETTINGS_MODULE" in os.environ:
+        load_django()
+
+    for args in celery_commands(os.environ):
+        pid = fork_celery(args)
+        # Gunicorn's arbiter reaps the Celery processes, as their parent
+        runtime.add_child(pid, "Celery " + args[0])
+
+    # Gunicorn re-executes sys.argv on SIGUSR2, so point it at the real script
+    sys.argv = [shutil.which("gunicorn") or "gunicorn"] + argv[1:]
+    from gunicorn.app.wsgiapp import run
+    run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,253 @@
+"""
+Sample the stack of the thread handling a request while the request runs, and
+write the samples as collapsed stacks (one line per stack, with the frames
+separated by semicolons and followed by the number of samples), the format
+used by Brendan Gregg's FlameGraph tools and by speedscope.
+
+Gunicorn's ``pre_request`` and ``post_request`` hooks profile a fraction of
+requests (``GUNICORN_PROFILE_RATE``), and requests with an ``X-DDB-Profile``
+header signed with ``GUNICORN_PROFILE_SECRET``. Each profile is written to a
+file in ``/run/gunicorn/profiles``. To look at them::
+
+    # Merge the profiles into a single collapsed stacks file
+    python -m django_bootstrap.profiling merge > profile.folded
+
+    # Render the profiles as a flame graph
+    python -m django_bootstrap.profiling flamegraph > profile.svg
+
+    # Get a header value to profile requests for a path in the next hour
+    python -m django_bootstrap.profiling sign /some/path/ 3600
+"""
+import hashlib
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from html import escape
+
+PROFILE_DIR = "/run/gunicorn/profiles"
+PROFILE_HEADER = "X-DDB-PROFILE"
+# Sample every 5ms, which costs a few percent of a CPU while a request is
+# being profiled
+INTERVAL = 0.005
+# Don't fill up /run if profiling is left on
+MAX_PROFILES = 1000
+
+FLAMEGRAPH_WIDTH = 1200
+FLAMEGRAPH_FRAME_HEIGHT = 16
+FLAMEGRAPH_TEMPLATE = """\
+<?xml version="1.0" standalone="no"?>
+<svg version="1.1" width="{width}" height="{height}" \
+xmlns="http://www.w3.org/2000/svg" font-family="Verdana" font-size="11">
+<rect width="100%" height="100%" fill="#f8f8f8"/>
+{frames}</svg>
+"""
+FLAMEGRAPH_FRAME_TEMPLATE = """\
+<g><title>{title}</title>\
+<rect x="{x:.1f}" y="{y}" width="{width:.1f}" height="{height}" \
+fill="{fill}" rx="2"/>\
+<text x="{text_x:.1f}" y="{text_y}">{label}</text></g>
+"""
+
+
+class Sampler:
+    """
+    Sample the stack of a thread from another thread, until stopped.
+    """
+
+    def __init__(self, thread_id=None, interval=INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and return a ``Counter`` of the stacks sampled, each a
+        tuple of frame names from the outermost frame inwards.
+        """
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[_stack(frame)] += 1
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        names.append("{}:{}".format(module, code.co_name).replace(";", ":"))
+        frame = frame.f_back
+    names.reverse()
+    return tuple(names)
+
+
+def signature(secret, path, expires):
+    message = "{}:{}".format(expires, path).encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def sign(secret, path, ttl=3600):
+    """
+    Return an ``X-DDB-Profile`` header value that requests a profile of
+    requests for the path until ``ttl`` seconds from now.
+    """
+    expires = int(time.time()) + int(ttl)
+    return "{}.{}".format(expires, signature(secret, path, expires))
+
+
+def verify(secret, path, value):
+    expires, _, sig = value.partition(".")
+    try:
+        if int(expires) < time.time():
+            return False
+    except ValueError:
+        return False
+    # Compare bytes, as compare_digest() raises TypeError for str with
+    # non-ASCII characters, which a client can send in the header
+    return hmac.compare_digest(
+        sig.encode("utf-8", "surrogateescape"),
+        signature(secret, path, expires).encode())
+
+
+def should_profile(method, path, headers, rate, secret=None):
+    """
+    Decide whether to profile a request, given its headers as a list of
+    (upper case name, value) tuples like Gunicorn's ``Request.headers``.
+    """
+    if secret:
+        for name, value in headers:
+            if name == PROFILE_HEADER:
+                return verify(secret, path, value)
+    return rate > 0 and random.random() < rate
+
+
+def write_profile(stacks, method, path, directory=PROFILE_DIR):
+    """
+    Write the stacks sampled for a request to a new file in the directory,
+    with the request method and path as the outermost frame. Returns the path
+    of the file, or ``None`` if nothing was written.
+    """
+    if not stacks:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    if len(os.listdir(directory)) >= MAX_PROFILES:
+        return None
+
+    root = "{} {}".format(method, path).replace(";", ":")
+    filename = os.path.join(directory, "{}-{}.folded".format(
+        time.strftime("%Y%m%dT%H%M%S"), os.urandom(4).hex()))
+    with open(filename, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write("{} {}\n".format(";".join((root,) + stack), count))
+    return filename
+
+
+def read_profiles(directory=PROFILE_DIR):
+    """
+    Return a ``Counter`` of the collapsed stacks in all the profiles in the
+    directory.
+    """
+    stacks = Counter()
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".folded"):
+            continue
+        with open(os.path.join(directory, name)) as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack and count.isdigit():
+                    stacks[stack] += int(count)
+    return stacks
+
+
+def merge(stacks):
+    return "".join(
+        "{} {}\n".format(stack, count)
+        for stack, count in sorted(stacks.items()))
+
+
+def flamegraph(stacks):
+    """
+    Render collapsed stacks as an SVG flame graph, with the outermost frames
+    at the bottom.
+    """
+    # Build a tree of {name: [count, children]}
+    root = [0, {}]
+    for stack, count in stacks.items():
+        node = root
+        node[0] += count
+        for name in stack.split(";"):
+            node = node[1].setdefault(name, [0, {}])
+            node[0] += count
+
+    depth = _depth(root) - 1
+    height = (depth + 1) * FLAMEGRAPH_FRAME_HEIGHT
+    frames = []
+    if root[0]:
+        scale = FLAMEGRAPH_WIDTH / root[0]
+        _render(root[1], 0, depth - 1, scale, root[0], frames)
+    return FLAMEGRAPH_TEMPLATE.format(
+        width=FLAMEGRAPH_WIDTH, height=height, frames="".join(frames))
+
+
+def _depth(node):
+    return 1 + max((_depth(child) for child in node[1].values()), default=0)
+
+
+def _render(children, x, level, scale, total, frames):
+    for name, (count, grandchildren) in sorted(children.items()):
+        width = count * scale
+        if width >= 0.5:
+            # Colour by name so that the same function is the same colour
+            hue = int(hashlib.md5(name.encode()).hexdigest()[:4], 16) % 55
+            # Roughly 7px per character
+            label = name[:int((width - 6) // 7)] if width > 20 else ""
+            frames.append(FLAMEGRAPH_FRAME_TEMPLATE.format(
+                title=escape("{} ({} samples, {:.2f}%)".format(
+                    name, count, 100 * count / total)),
+                x=x, y=level * FLAMEGRAPH_FRAME_HEIGHT,
+                width=width, height=FLAMEGRAPH_FRAME_HEIGHT - 1,
+                fill="hsl({}, 80%, 60%)".format(hue),
+                text_x=x + 3, text_y=(level + 1) * FLAMEGRAPH_FRAME_HEIGHT - 4,
+                label=escape(label)))
+            _render(grandchildren, x, level - 1, scale, total, frames)
+        x += width
+
+
+def main(command=None, *args):
+    if command == "merge":
+        sys.stdout.write(merge(read_profiles(*args)))
+    elif command == "flamegraph":
+        stacks = read_profiles(*args)
+        if not stacks:
+            sys.exit("No profiles found")
+        sys.stdout.write(flamegraph(stacks))
+    elif command == "sign" and 1 <= len(args) <= 2:
+        secret = os.environ.get("GUNICORN_PROFILE_SECRET")
+        if not secret:
+            sys.exit("$GUNICORN_PROFILE_SECRET must be set")
+        print(sign(secret, *args))
+    else:
+        sys.exit(
+            "Usage: python -m django_bootstrap.profiling merge [DIRECTORY]\n"
+            "       python -m django_bootstrap.profiling flamegraph "
+            "[DIRECTORY]\n"
+            "       python -m django_bootstrap.profiling sign PATH [TTL]")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
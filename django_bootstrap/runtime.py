@@ -0,0 +1,95 @@
+"""
+Paths and helpers shared by the Gunicorn config in the image and the other
+processes that the entrypoint script starts.
+"""
+import ctypes
+import json
+import os
+import signal
+
+# State files used by Nginx to answer health checks. The directory is created
+# by the entrypoint script.
+STATE_DIR = "/run/ddb"
+
+# Where the Prometheus client's multiprocess mode writes its files, unless
+# $prometheus_multiproc_dir is set
+DEFAULT_PROMETHEUS_MULTIPROC_DIR = "/run/gunicorn/prometheus"
+
+# From <linux/prctl.h>
+PR_SET_PDEATHSIG = 1
+
+# The processes started alongside Gunicorn's default arbiter, as its children,
+# as comma-separated "<pid>=<description>" entries
+CHILDREN_VAR = "DDB_CHILDREN"
+
+
+def prometheus_multiproc_dir(default=True):
+    """
+    Set ``prometheus_multiproc_dir`` to the default path if it isn't set (and
+    ``default`` is true), then create the directory and its parents. Returns
+    the path, or ``None`` if multiprocess mode isn't used. Raises ``OSError``
+    if the directory can't be created.
+
+    This must happen before the Prometheus client is first imported, which
+    chooses whether to use multiprocess mode then.
+    """
+    if default:
+        # Don't override an existing value
+        os.environ.setdefault(
+            "prometheus_multiproc_dir", DEFAULT_PROMETHEUS_MULTIPROC_DIR)
+
+    path = os.environ.get("prometheus_multiproc_dir")
+    if path:
+        os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_json(path, data):
+    """
+    Write the data to a JSON file. The file is written to a temporary file
+    and renamed so that Nginx never serves a partially-written file.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def stop_with_parent(signum=signal.SIGTERM):
+    """
+    Have the kernel send this process a signal (SIGTERM, to shut down
+    gracefully) when its parent exits. The container's init process only
+    signals the process that the entrypoint script runs, not the processes
+    that it forks.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.prctl(PR_SET_PDEATHSIG, signum)
+    # The parent may have exited before that took effect
+    if os.getppid() == 1:
+        os.kill(os.getpid(), signum)
+
+
+def add_child(pid, description, environ=os.environ):
+    """
+    Record a process that is started alongside Gunicorn's default arbiter, as
+    its child (e.g. Celery with SHARED_PRELOAD), so that the arbiter can tell
+    it apart from its workers when it exits. The entrypoint script records the
+    worker pools' arbiters the same way, in ``$DDB_CHILDREN``.
+    """
+    entry = "{}={}".format(pid, description)
+    children = environ.get(CHILDREN_VAR)
+    environ[CHILDREN_VAR] = "{},{}".format(children, entry) if children else (
+        entry)
+
+
+def children(environ=os.environ):
+    """
+    Return a dict of the pids of the processes recorded with ``add_child()``
+    to their descriptions.
+    """
+    found = {}
+    for entry in environ.get(CHILDREN_VAR, "").split(","):
+        pid, _, description = entry.partition("=")
+        if pid.strip().isdigit():
+            found[int(pid)] = description
+    return found
@@ -0,0 +1,37 @@
+"""
+Helpers for use in Django settings files. These must not import anything from
+Django that requires the settings to be configured.
+"""
+from django_bootstrap import pgbouncer
+
+# Close persistent connections after 10 minutes so that they're recycled
+# every now and then
+DEFAULT_CONN_MAX_AGE = 600
+
+
+def persistent_database(config, conn_max_age=DEFAULT_CONN_MAX_AGE,
+                        health_checks=True):
+    """
+    Configure a database for persistent connections, so that each Gunicorn
+    worker (or Celery process) keeps its connection open between requests
+    rather than connecting to the database for every request.
+
+    :param config:
+        The database config dict, e.g. as returned by django-environ's
+        ``env.db()``.
+    :param conn_max_age:
+        The maximum age of a connection in seconds, or ``None`` for unlimited.
+    :param health_checks:
+        Whether to check that a connection is still usable before reusing it
+        for a new request. See :mod:`django_bootstrap.db` for how this is done
+        on versions of Django before 4.1.
+    """
+    config = dict(config)
+    config["CONN_MAX_AGE"] = conn_max_age
+    config["CONN_HEALTH_CHECKS"] = health_checks
+
+    # Server-side cursors can't be used with PgBouncer's transaction pooling
+    if config.get("OPTIONS", {}).get("host") == pgbouncer.SOCKET_DIR:
+        config["DISABLE_SERVER_SIDE_CURSORS"] = True
+
+    return config
@@ -0,0 +1,52 @@
+"""
+Report slow requests in Gunicorn workers. The functions here are called by the
+Gunicorn config in the image.
+"""
+import faulthandler
+import os
+import sys
+
+try:
+    from prometheus_client import Counter
+except ImportError:
+    Counter = None
+
+if Counter is not None:
+    SLOW_REQUESTS = Counter(
+        "django_bootstrap_slow_requests_total",
+        "Number of requests that took longer than "
+        "$GUNICORN_SLOW_REQUEST_TIMEOUT",
+        ["path"])
+else:
+    SLOW_REQUESTS = None
+
+UNMATCHED_PATH = "<unmatched>"
+
+
+def install(signum):
+    """
+    Dump the stacks of all of this process's threads to stderr when the
+    process receives the signal.
+    """
+    faulthandler.register(signum, file=sys.stderr, all_threads=True)
+
+
+def count_slow_request(path):
+    if SLOW_REQUESTS is not None:
+        SLOW_REQUESTS.labels(path_label(path)).inc()
+
+
+def path_label(path):
+    """
+    Return the Django URL pattern that matches the path (e.g.
+    ``articles/<int:year>/``), so that the number of label values doesn't
+    grow with the number of objects on the site.
+    """
+    if "DJANGO_SETTINGS_MODULE" not in os.environ:
+        return path
+
+    from django.urls import Resolver404, resolve
+    try:
+        return resolve(path).route
+    except Resolver404:
+        return UNMATCHED_PATH
@@ -0,0 +1,122 @@
+"""
+Generate an Nginx map of the URLs of static files that have hashes in their
+names, from the manifests written by Django's ManifestStaticFilesStorage and
+by django-compressor's offline compression. Nginx looks up each static file
+request in the map (a hash table) to decide whether the file can be cached
+indefinitely.
+
+Run in your Dockerfile after ``collectstatic`` (and ``compress``)::
+
+    RUN django-admin collectstatic --noinput \\
+        && python -m django_bootstrap.static
+
+This replaces the default map, which guesses which files are hashed using
+regular expressions. The entrypoint script also runs this, with
+``--optional``, when it collects static files as the container starts. Then
+the map is left as it is if there are no manifests.
+"""
+import json
+import os
+import re
+import sys
+from urllib.parse import unquote
+
+STATIC_URL = "/static/"
+# Files are served from the first of these that they're found in. See
+# locations/static.conf.
+STATIC_ROOTS = ("/app/static", "/app/staticfiles")
+
+# Default file names for the manifests
+STATICFILES_MANIFEST = "staticfiles.json"
+COMPRESSOR_MANIFEST = os.path.join("CACHE", "manifest.json")
+
+MAP_PATH = "/etc/nginx/conf.d/django.conf.d/maps/static_files.conf"
+# Keys longer than this don't fit in the map's hash buckets. See
+# map_hash_bucket_size in nginx.conf.
+MAX_KEY_LENGTH = 200
+
+# Links to compressed files in django-compressor's rendered HTML
+COMPRESSOR_URL_RE = re.compile(r'(?:src|href)="([^"]+)"')
+
+MAP_TEMPLATE = """\
+# Static files that have hashes in their names, and so can be cached
+# indefinitely. Generated by django_bootstrap.static from the static file
+# manifests.
+map $uri $static_immutable {{
+{entries}}}
+"""
+
+
+def _load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def staticfiles_urls(static_root):
+    manifest = _load_json(os.path.join(static_root, STATICFILES_MANIFEST))
+    if manifest is None:
+        return set()
+    return {STATIC_URL + path for path in manifest["paths"].values()}
+
+
+def compressor_urls(static_root):
+    manifest = _load_json(os.path.join(static_root, COMPRESSOR_MANIFEST))
+    if manifest is None:
+        return set()
+    urls = set()
+    for html in manifest.values():
+        # Nginx matches against the decoded URI
+        urls.update(
+            unquote(url) for url in COMPRESSOR_URL_RE.findall(html)
+            if url.startswith(STATIC_URL))
+    return urls
+
+
+def immutable_urls(static_roots):
+    urls = set()
+    for static_root in static_roots:
+        urls.update(staticfiles_urls(static_root))
+        urls.update(compressor_urls(static_root))
+    return urls
+
+
+def _quote(value):
+    return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def map_config(urls):
+    entries = "".join(
+        "    {} 1;\n".format(_quote(url)) for url in sorted(urls))
+    return MAP_TEMPLATE.format(entries=entries)
+
+
+def main(map_path=MAP_PATH, optional=False):
+    urls = immutable_urls(STATIC_ROOTS)
+    if not urls and optional:
+        print("No static file manifests found, not changing {}".format(
+            map_path))
+        return
+    if not urls:
+        sys.exit(
+            "No static file manifests found in {}. Run collectstatic with "
+            "ManifestStaticFilesStorage first.".format(
+                " or ".join(STATIC_ROOTS)))
+
+    # These files will just be cached for a shorter time
+    for url in sorted(url for url in urls if len(url) > MAX_KEY_LENGTH):
+        print("Skipping static file URL longer than {} characters: {}"
+              .format(MAX_KEY_LENGTH, url), file=sys.stderr)
+        urls.remove(url)
+
+    with open(map_path, "w") as f:
+        f.write(map_config(urls))
+    print("Wrote {} static file URLs to {}".format(len(urls), map_path))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*[arg for arg in args if arg != "--optional"],
+         optional="--optional" in args)
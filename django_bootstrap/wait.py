@@ -0,0 +1,229 @@
+"""
+Wait for the database and the Celery broker to accept connections, so that
+the container doesn't exit (and pay for starting Python and Django all over
+again when it's restarted) because a dependency is briefly unavailable.
+
+Run by the entrypoint script, before any Django management commands, when
+``DEPENDENCY_WAIT_TIMEOUT`` is set::
+
+    python -m django_bootstrap.wait
+
+The dependencies are given by the ``DATABASE_URL`` and ``CELERY_BROKER_URL``
+environment variables. Each one is probed at the same time, in its own
+thread, retrying with exponential backoff until it responds or the timeout
+(in seconds) passes. Neither Django nor any database drivers are imported.
+"""
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+
+# Delays between attempts, in seconds
+INITIAL_DELAY = 0.1
+MAX_DELAY = 5
+# The longest to wait for each attempt to connect and get a response
+ATTEMPT_TIMEOUT = 5
+
+POSTGRES_SCHEMES = ("postgres", "postgresql", "pgsql", "postgis")
+AMQP_SCHEMES = ("amqp", "amqps", "pyamqp")
+REDIS_SCHEMES = ("redis", "rediss")
+
+DEFAULT_PORTS = {
+    "postgres": 5432,
+    "postgresql": 5432,
+    "pgsql": 5432,
+    "postgis": 5432,
+    "mysql": 3306,
+    "mysql2": 3306,
+    "amqp": 5672,
+    "amqps": 5671,
+    "pyamqp": 5672,
+    "redis": 6379,
+    "rediss": 6379,
+}
+
+# From PostgreSQL's errcodes.txt
+PG_CANNOT_CONNECT_NOW = b"57P03"
+PG_PROTOCOL_VERSION = 3 << 16
+AMQP_PROTOCOL_HEADER = b"AMQP\x00\x00\x09\x01"
+AMQP_FRAME_METHOD = 1
+
+
+class NotReady(Exception):
+    pass
+
+
+class Dependency:
+    """
+    A service to wait for, and how to check that it's ready.
+    """
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = urlsplit(url)
+        self.host = self.url.hostname
+        self.port = self.url.port or DEFAULT_PORTS.get(self.url.scheme)
+
+    def __str__(self):
+        return "{} at {}:{}".format(self.name, self.host, self.port)
+
+    def check(self, timeout):
+        """
+        Raise ``NotReady`` or ``OSError`` if the service isn't ready yet.
+        """
+        with socket.create_connection(
+                (self.host, self.port), timeout=timeout) as sock:
+            # Only check the protocol where a service can accept connections
+            # before it is ready to use
+            if self.url.scheme in POSTGRES_SCHEMES:
+                self._check_postgres(sock)
+            elif self.url.scheme in AMQP_SCHEMES:
+                self._check_amqp(sock)
+            elif self.url.scheme in REDIS_SCHEMES:
+                self._check_redis(sock)
+
+    def _check_postgres(self, sock):
+        # Start a session, unencrypted. The server asks for authentication
+        # once it is ready, and refuses with an error while it's starting up.
+        # Other errors (e.g. a missing database) mean that the server is up.
+        params = [
+            ("user", unquote(self.url.username or "postgres")),
+            ("database", unquote(self.url.path[1:] or "postgres")),
+        ]
+        body = struct.pack("!I", PG_PROTOCOL_VERSION) + b"".join(
+            k.encode() + b"\0" + v.encode() + b"\0" for k, v in params) + b"\0"
+        sock.sendall(struct.pack("!I", len(body) + 4) + body)
+
+        response = _recv_some(sock)
+        if response[:1] == b"E" and b"C" + PG_CANNOT_CONNECT_NOW in response:
+            raise NotReady("the database system is starting up")
+        if response[:1] not in (b"R", b"E"):
+            raise NotReady("unexpected response from PostgreSQL")
+
+    def _check_amqp(self, sock):
+        # The broker sends Connection.Start once it's ready
+        if self.url.scheme == "amqps":
+            return
+        sock.sendall(AMQP_PROTOCOL_HEADER)
+        if _recv_some(sock)[:1] != bytes([AMQP_FRAME_METHOD]):
+            raise NotReady("unexpected response from the AMQP broker")
+
+    def _check_redis(self, sock):
+        # Redis answers with an error (e.g. -LOADING) until it is ready, but
+        # without a password, -NOAUTH also means it is up
+        if self.url.scheme == "rediss":
+            return
+        sock.sendall(b"PING\r\n")
+        response = _recv_some(sock)
+        if not (response.startswith(b"+PONG") or
+                response.startswith(b"-NOAUTH")):
+            raise NotReady(response.decode(errors="replace").strip())
+
+
+def _recv_some(sock):
+    data = sock.recv(4096)
+    if not data:
+        raise NotReady("the connection was closed")
+    return data
+
+
+def dependencies(environ=os.environ):
+    """
+    Return the dependencies from the environment that can be probed over TCP.
+    Raises ``ValueError`` if a URL has an invalid port.
+    """
+    found = []
+    for name, var in (("database", "DATABASE_URL"),
+                      ("broker", "CELERY_BROKER_URL")):
+        url = environ.get(var)
+        if not url:
+            continue
+        try:
+            dependency = Dependency(name, url)
+        except ValueError:
+            # e.g. a port that isn't a number, or is out of range
+            raise ValueError("${} has an invalid port".format(var))
+        # e.g. SQLite, or a Unix socket
+        if dependency.host and dependency.port:
+            found.append(dependency)
+    return found
+
+
+def wait_for(dependency, deadline, log=print):
+    """
+    Check the dependency, with exponential backoff, until it's ready or the
+    deadline (a ``time.monotonic()`` value) passes. Returns whether it's
+    ready.
+    """
+    start = time.monotonic()
+    delay = INITIAL_DELAY
+    last_error = None
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            dependency.check(max(0.1, min(ATTEMPT_TIMEOUT, remaining)))
+        except (OSError, NotReady) as e:
+            error = str(e) or type(e).__name__
+            # Only log each new error rather than every attempt
+            if error != last_error:
+                log("Waiting for {}: {}".format(dependency, error))
+                last_error = error
+        else:
+            if last_error is not None:
+                log("{} is ready after {:.1f}s".format(
+                    dependency, time.monotonic() - start))
+            return True
+
+        # Jitter the delay so that many containers don't retry in lockstep
+        sleep = delay * random.uniform(0.5, 1)
+        if time.monotonic() + sleep >= deadline:
+            return False
+        time.sleep(sleep)
+        delay = min(delay * 2, MAX_DELAY)
+
+
+def wait(timeout, environ=os.environ, log=print):
+    """
+    Wait for all the dependencies at once. Returns the dependencies that
+    weren't ready in time.
+    """
+    deadline = time.monotonic() + timeout
+    results = {}
+
+    def run(dependency):
+        results[dependency] = wait_for(dependency, deadline, log)
+
+    threads = [
+        threading.Thread(target=run, args=(dependency,))
+        for dependency in dependencies(environ)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [dependency for dependency, ready in results.items() if not ready]
+
+
+def main():
+    try:
+        timeout = float(os.environ.get("DEPENDENCY_WAIT_TIMEOUT") or "60")
+    except ValueError:
+        sys.exit("$DEPENDENCY_WAIT_TIMEOUT must be a number of seconds")
+
+    def log(message):
+        print(message, file=sys.stderr, flush=True)
+
+    try:
+        not_ready = wait(timeout, log=log)
+    except ValueError as e:
+        sys.exit(str(e))
+    if not_ready:
+        sys.exit("Gave up waiting after {:g}s for: {}".format(
+            timeout, ", ".join(str(d) for d in not_ready)))
+
+
+if __name__ == "__main__":
+    main()
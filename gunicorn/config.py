@@ -1,6 +1,17 @@
+import asyncio
 import errno
+import fcntl
+import io
+import json
 import os
+import signal
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
 
+from gunicorn.errors import HaltServer
+from gunicorn.glogging import Logger, SafeAtoms
 from gunicorn.workers.sync import SyncWorker
 
 # See http://docs.gunicorn.org/en/latest/settings.html for a list of available
@@ -19,11 +30,170 @@ umask = 0o117
 # http://docs.gunicorn.org/en/latest/faq.html#blocking-os-fchmod
 worker_tmp_dir = "/run/gunicorn"
 
+# Run the arbiter for a named worker pool (see django_bootstrap.pools), which
+# the entrypoint script starts for each pool in $GUNICORN_POOLS alongside the
+# default pool
+POOL = os.environ.get("GUNICORN_POOL")
+if POOL:
+    from django_bootstrap import pools
+    _pool = pools.pool(POOL)
+    pidfile = pools.pid_path(POOL)
+    bind = "unix:" + pools.socket_path(POOL)
+    workers = _pool.workers
+    timeout = _pool.timeout
+    proc_name = "gunicorn-" + POOL
+
+# Worker profiles. The sync worker (the default) handles one request at a time.
+# The gthread and gevent workers handle many requests at once, which suits
+# sites that spend most of their time waiting on other services. Unlike the
+# sync worker, they can keep connections from Nginx open between requests.
+# Options given on the command line or in GUNICORN_CMD_ARGS take precedence.
+WORKER_PROFILE = os.environ.get("GUNICORN_WORKER_PROFILE", "sync")
+if WORKER_PROFILE == "gthread":
+    worker_class = "gthread"
+    threads = 4
+elif WORKER_PROFILE == "gevent":
+    worker_class = "gevent"
+    # Each greenlet may hold a database connection, so keep this modest
+    worker_connections = 100
+elif WORKER_PROFILE == "asgi":
+    # Serve an ASGI app (e.g. mysite.asgi:application) with Uvicorn
+    worker_class = "uvicorn.workers.UvicornWorker"
+    # Uvicorn only trusts the X-Forwarded-* headers from these addresses.
+    # Requests come from Nginx over the Unix socket, which has no address.
+    forwarded_allow_ips = "*"
+elif WORKER_PROFILE != "sync":
+    raise ValueError(
+        "Unknown $GUNICORN_WORKER_PROFILE '{}', must be one of: asgi, "
+        "gevent, gthread, sync".format(WORKER_PROFILE))
+
+if WORKER_PROFILE != "sync":
+    # Keep idle connections from Nginx open for longer than Nginx does (60s),
+    # so that Nginx never reuses a connection that Gunicorn is closing
+    keepalive = 75
+
+if WORKER_PROFILE == "gevent":
+    # Gunicorn patches the standard library in each worker before loading the
+    # app, but if the app is preloaded Django is imported in the arbiter
+    # first. So patch as early as possible, before anything imports Django.
+    from gevent import monkey
+    monkey.patch_all()
+
+    # Make psycopg2 cooperative too, if psycogreen is installed
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        pass
+    else:
+        patch_psycopg()
+
 if os.environ.get("GUNICORN_ACCESS_LOGS"):
     accesslog = "-"
 
+# Optionally log access logs as JSON, in the same format as Nginx's access
+# logs, rather than in Apache's combined format
+ACCESS_LOG_JSON = os.environ.get("GUNICORN_ACCESS_LOG_FORMAT") == "json"
+JSON_ACCESS_LOG_FORMAT = (
+    '{ '
+    '"time": "%(time_iso8601)s", '
+    '"remote_addr": "%(h)s", '
+    '"remote_user": "%(u)s", '
+    '"request": "%(r)s", '
+    '"status": %(s)s, '
+    '"body_bytes_sent": %(B)s, '
+    '"request_time": %(L)s, '
+    '"http_host": "%({host}i)s", '
+    '"http_referer": "%({referer}i)s", '
+    '"http_user_agent": "%({user-agent}i)s", '
+    '"http_via": "%({via}i)s", '
+    '"http_x_forwarded_proto": "%({x-forwarded-proto}i)s", '
+    '"http_x_forwarded_for": "%({x-forwarded-for}i)s" '
+    '}'
+)
+
+# Replace workers one at a time on SIGHUP rather than all at once
+ROLLING_RELOAD = bool(os.environ.get("GUNICORN_ROLLING_RELOAD"))
+# Warm up each worker before it starts accepting requests. Setting a warmup URL
+# implies warming up.
+WARMUP_URL = os.environ.get("GUNICORN_WARMUP_URL")
+WARMUP = bool(os.environ.get("GUNICORN_WARMUP")) or bool(WARMUP_URL)
+WARMUP_HOST = os.environ.get("GUNICORN_WARMUP_HOST", "localhost")
+WARMUP_TEMPLATES = [
+    t for t in os.environ.get("GUNICORN_WARMUP_TEMPLATES", "").split(",") if t]
+
+
+# Pin each worker to its own CPU
+CPU_AFFINITY = bool(os.environ.get("GUNICORN_CPU_AFFINITY"))
+
+# Profile a fraction of requests, and requests with a signed header. Stacks
+# are sampled from another thread, which doesn't work with gevent's greenlets,
+# and Uvicorn's workers don't call the request hooks.
+PROFILE_RATE = float(os.environ.get("GUNICORN_PROFILE_RATE", "0"))
+PROFILE_SECRET = os.environ.get("GUNICORN_PROFILE_SECRET")
+PROFILING = (
+    (PROFILE_RATE > 0 or bool(PROFILE_SECRET)) and
+    WORKER_PROFILE in ("sync", "gthread"))
+
+# Dump the stack of workers that have been handling a request for longer than
+# this many seconds, and count slow requests by path
+SLOW_REQUEST_TIMEOUT = float(
+    os.environ.get("GUNICORN_SLOW_REQUEST_TIMEOUT", "0"))
+SLOW_REQUEST_SIGNAL = signal.SIGUSR2
+# Set on the worker temporary file (in addition to the bit Gunicorn flips to
+# update its ctime) while a sync worker is handling a request
+BUSY_MODE = 0o2
+
+# Run deep health checks in the background every this many seconds, for the
+# /_ddb/health health check
+HEALTH_CHECK_INTERVAL = float(
+    os.environ.get("GUNICORN_HEALTH_CHECK_INTERVAL", "0"))
+
+# Replace values of Prometheus metric labels beyond this many per label (in
+# each process) with "other"
+PROMETHEUS_MAX_LABEL_VALUES = int(
+    os.environ.get("PROMETHEUS_MAX_LABEL_VALUES", "0"))
+
+
+class JSONAtoms(SafeAtoms):
+    """
+    Escape access log values for JSON strings, rather than just escaping
+    double quotes. Missing values are empty, like in Nginx's logs.
+    """
+
+    def __init__(self, atoms):
+        dict.__init__(self)
+        for key, value in atoms.items():
+            if value is None:
+                value = ""
+            elif isinstance(value, str):
+                value = json.dumps(value)[1:-1]
+            self[key] = value
+
+    def __getitem__(self, k):
+        value = super().__getitem__(k)
+        if k.startswith("{") and value == "-" and k.lower() not in self:
+            return ""
+        return value
+
 
-DEFAULT_PROMETHEUS_MULTIPROC_DIR = "/run/gunicorn/prometheus"
+class JSONLogger(Logger):
+    atoms_wrapper_class = JSONAtoms
+
+    def atoms(self, resp, req, environ, request_time):
+        atoms = super().atoms(resp, req, environ, request_time)
+        atoms.update({
+            # The same format as Nginx's $time_iso8601
+            "time_iso8601": datetime.now().astimezone().isoformat(
+                timespec="seconds"),
+            "u": self._get_user(environ) or "",
+            "B": atoms["B"] or 0,
+        })
+        return atoms
+
+
+if ACCESS_LOG_JSON:
+    logger_class = JSONLogger
+    access_log_format = JSON_ACCESS_LOG_FORMAT
 
 
 def nworkers_changed(server, new_value, old_value):
@@ -36,29 +206,160 @@ def nworkers_changed(server, new_value, old_value):
     if old_value is not None:
         return
 
+    from django_bootstrap import runtime
+
     # If there are multiple processes (num_workers > 1) or the workers are
     # synchronous (in which case in production the num_workers will need to be
-    # >1), enable multiprocess mode by default.
-    if server.num_workers > 1 or server.worker_class == SyncWorker:
-        # Don't override an existing value
-        if "prometheus_multiproc_dir" not in os.environ:
-            os.environ["prometheus_multiproc_dir"] = (
-                DEFAULT_PROMETHEUS_MULTIPROC_DIR)
-
-    # Try to create the prometheus_multiproc_dir if set but fail gracefully
-    if "prometheus_multiproc_dir" in os.environ:
-        path = os.environ["prometheus_multiproc_dir"]
-        # mkdir -p equivalent: https://stackoverflow.com/a/600612/3077893
+    # >1), enable multiprocess mode by default. With SHARED_PRELOAD, this has
+    # already been done before Django was imported (see
+    # django_bootstrap.preload). Try to create the prometheus_multiproc_dir if
+    # set but fail gracefully.
+    default = server.num_workers > 1 or server.worker_class == SyncWorker
+    try:
+        runtime.prometheus_multiproc_dir(default)
+    except OSError as e:
+        server.log.warning(
+            ("Unable to create prometheus_multiproc_dir directory at "
+             "'%s'"), os.environ["prometheus_multiproc_dir"], exc_info=e)
+
+    # Limit the number of values of each metric label in each process. This is
+    # done in the arbiter so that it applies even if the app is preloaded.
+    if PROMETHEUS_MAX_LABEL_VALUES:
         try:
-            os.makedirs(path)
-        except OSError as e:
-            if e.errno != errno.EEXIST or not os.path.isdir(path):
-                server.log.warning(
-                    ("Unable to create prometheus_multiproc_dir directory at "
-                     "'%s'"), path, exc_info=e)
+            from django_bootstrap import metrics
+        except ImportError:
+            server.log.warning(
+                "$PROMETHEUS_MAX_LABEL_VALUES is set but prometheus_client "
+                "isn't installed")
+        else:
+            metrics.install(PROMETHEUS_MAX_LABEL_VALUES)
+
+
+def pre_fork(server, worker):
+    # If the app is preloaded, Django may have connected to the database in
+    # the arbiter. A connection must never be shared between processes, so
+    # close it before forking.
+    if "django.db" in sys.modules:
+        from django_bootstrap import db
+        db.close_connections()
+
+    # Choose the CPU in the arbiter, which knows which CPUs the other workers
+    # are pinned to
+    if CPU_AFFINITY:
+        worker.cpu_affinity = _choose_cpu(server)
+
+
+def post_fork(server, worker):
+    cpu = getattr(worker, "cpu_affinity", None)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+        server.log.info("Worker with pid %s pinned to CPU %s", worker.pid, cpu)
+
+    # Set up database connection management in the worker before the app is
+    # loaded so that all the connections the worker opens are counted.
+    if "DJANGO_SETTINGS_MODULE" in os.environ:
+        from django_bootstrap import db
+        db.install()
+
+
+def _choose_cpu(server):
+    from django_bootstrap import cgroups
+
+    # Workers take CPUs from the start of the list and Nginx's workers from
+    # the end (see django_bootstrap.nginx), so that they only share CPUs if
+    # there aren't enough to go around.
+    cpus = cgroups.allowed_cpus()
+    if len(cpus) < max(2, server.num_workers):
+        # Pinning several workers to one CPU would leave the others idle
+        server.log.info(
+            "Not pinning workers to CPUs: %s workers but %s CPUs available",
+            server.num_workers, len(cpus))
+        return None
+
+    in_use = {
+        getattr(w, "cpu_affinity", None) for w in server.WORKERS.values()}
+    for cpu in cpus:
+        if cpu not in in_use:
+            return cpu
+    # e.g. while a rolling reload has an extra worker running
+    return None
+
+
+def pre_request(worker, req):
+    # Gunicorn's default pre_request hook
+    worker.log.debug("%s %s", req.method, req.path)
+
+    if SLOW_REQUEST_TIMEOUT:
+        req.ddb_started = time.monotonic()
+        if WORKER_PROFILE == "sync":
+            _set_busy(worker, True)
+
+    if PROFILING:
+        from django_bootstrap import profiling
+        if profiling.should_profile(
+                req.method, req.path, req.headers, PROFILE_RATE,
+                PROFILE_SECRET):
+            req.ddb_sampler = profiling.Sampler()
+            req.ddb_sampler.start()
+
+
+def post_request(worker, req, environ, resp):
+    started = getattr(req, "ddb_started", None)
+    if started is not None:
+        if WORKER_PROFILE == "sync":
+            _set_busy(worker, False)
+        if time.monotonic() - started > SLOW_REQUEST_TIMEOUT:
+            from django_bootstrap import slow
+            slow.count_slow_request(req.path)
+
+    sampler = getattr(req, "ddb_sampler", None)
+    if sampler is None:
+        return
+
+    from django_bootstrap import profiling
+    stacks = sampler.stop()
+    try:
+        path = profiling.write_profile(stacks, req.method, req.path)
+    except OSError:
+        worker.log.warning("Unable to write profile", exc_info=True)
+    else:
+        if path is not None:
+            worker.log.info(
+                "Profiled %s %s: %s", req.method, req.path, path)
+
+
+def _set_busy(worker, busy):
+    # Like Gunicorn's WorkerTmp.notify(), this updates the file's ctime, so
+    # the arbiter sees how long the worker has been busy for
+    mode = worker.tmp.spinner | (BUSY_MODE if busy else 0)
+    os.fchmod(worker.tmp.fileno(), mode)
 
 
 def worker_exit(server, worker):
+    # Stop counting the worker as ready as soon as it starts exiting
+    _update_state(worker_stopped=worker.pid)
+
+    # Close persistent database connections cleanly rather than just dropping
+    # them when the process exits
+    if "django.db" in sys.modules:
+        from django_bootstrap import db
+        try:
+            db.close_connections()
+        except Exception:
+            server.log.warning(
+                "Unable to close database connections", exc_info=True)
+
+    _mark_process_dead(worker.pid)
+
+
+def child_exit(server, worker):
+    # Workers that are killed (e.g. on timeout) don't get a chance to call
+    # worker_exit, so clean up after them once they've been reaped.
+    _update_state(worker_stopped=worker.pid)
+    _mark_process_dead(worker.pid)
+
+
+def _mark_process_dead(pid):
     # Do bookkeeping for Prometheus collectors for each worker process as they
     # exit, as described in the prometheus_client documentation:
     # https://github.com/prometheus/client_python#multiprocess-mode-gunicorn
@@ -66,8 +367,424 @@ def worker_exit(server, worker):
         # Don't error if the environment variable has been set but
         # prometheus_client isn't installed
         try:
-            from prometheus_client import multiprocess
+            from django_bootstrap import metrics
         except ImportError:
             return
 
-        multiprocess.mark_process_dead(worker.pid)
+        metrics.mark_process_dead(pid)
+
+
+def on_starting(server):
+    if POOL:
+        # The container's init process only signals the default pool's
+        # arbiter (our parent), so stop when it exits
+        from django_bootstrap import runtime
+        runtime.stop_with_parent()
+    else:
+        # The arbiter is also the parent of the worker pools' arbiters and
+        # (with SHARED_PRELOAD) the Celery processes. Gunicorn would reap them
+        # as if they were workers, so swap out the arbiter's method for that.
+        server.reap_workers = lambda: _reap_workers(server)
+
+
+def when_ready(server):
+    _update_state()
+
+    if not POOL and os.environ.get("GUNICORN_POOLS"):
+        # Reload the other pools along with this one
+        handle_hup = server.handle_hup
+
+        def reload_pools():
+            from django_bootstrap import pools
+            pools.signal_pools(signal.SIGHUP, server.log)
+            handle_hup()
+        server.handle_hup = reload_pools
+
+    # Start failing readiness checks as soon as we're asked to shut down, so
+    # that no new requests are routed to us while the workers finish up.
+    for signame in ("term", "int", "quit"):
+        handler = getattr(server, "handle_" + signame)
+        setattr(server, "handle_" + signame, _draining(handler))
+
+    if SLOW_REQUEST_TIMEOUT and WORKER_PROFILE == "sync":
+        # The arbiter checks for workers that have timed out about once a
+        # second, so check for slow requests at the same time
+        murder_workers = server.murder_workers
+        dumped = {}
+
+        def check_workers():
+            _check_slow_requests(server, dumped)
+            murder_workers()
+        server.murder_workers = check_workers
+
+    if HEALTH_CHECK_INTERVAL and not POOL:
+        # Stop passing the deep health check if the results stop being
+        # updated, e.g. because a check or the worker running them is stuck
+        server.murder_workers = _expiring_health_checks(
+            server, server.murder_workers)
+
+    if ROLLING_RELOAD:
+        # There's no hook that lets us change how Gunicorn replaces workers on
+        # a reload, so swap out the arbiter's reload method for our own.
+        reload = server.reload
+        server.reload = lambda: _rolling_reload(server, reload)
+
+
+def _check_slow_requests(server, dumped):
+    # dumped maps the pids of workers whose stacks have been dumped to the
+    # time their current request started, so that each request is only dumped
+    # once
+    for pid in set(dumped) - set(server.WORKERS):
+        del dumped[pid]
+
+    for pid, worker in list(server.WORKERS.items()):
+        try:
+            stat = os.fstat(worker.tmp.fileno())
+        except (OSError, ValueError):
+            continue
+        if not stat.st_mode & BUSY_MODE:
+            continue
+        busy_for = time.time() - stat.st_ctime
+        if (busy_for <= SLOW_REQUEST_TIMEOUT or
+                dumped.get(pid) == stat.st_ctime):
+            continue
+
+        dumped[pid] = stat.st_ctime
+        server.log.warning(
+            "Slow request in worker with pid %s, running for %.1fs. Dumping "
+            "its stack.", pid, busy_for)
+        try:
+            os.kill(pid, SLOW_REQUEST_SIGNAL)
+        except OSError:
+            pass
+
+
+def _rolling_reload(server, reload):
+    old_pids = list(server.WORKERS.keys())
+
+    # Let Gunicorn do everything it normally does on a reload (reload the
+    # config, reopen log files, rebind sockets, etc.) except for replacing the
+    # workers, which it does by spawning all the new workers and then
+    # immediately killing all the old ones--before the new ones have booted.
+    server.spawn_worker = lambda: None
+    server.manage_workers = lambda: None
+    try:
+        reload()
+    finally:
+        del server.spawn_worker
+        del server.manage_workers
+
+    # Now replace the old workers one at a time, only retiring an old worker
+    # once its replacement has booted, warmed up, and is accepting requests.
+    spawned = 0
+    for pid in old_pids:
+        if spawned < server.num_workers:
+            _spawn_worker_and_wait(server)
+            spawned += 1
+        server.log.info("Retiring worker with pid: %s", pid)
+        server.kill_worker(pid, signal.SIGTERM)
+
+    # In case the number of workers changed with the reloaded config
+    server.manage_workers()
+
+
+def _spawn_worker_and_wait(server):
+    pid = server.spawn_worker()
+    worker = server.WORKERS[pid]
+
+    # Workers only start "notifying" the arbiter (by touching their temporary
+    # file) once they're in their main loop, accepting requests. So wait until
+    # the temporary file changes. Workers have to boot within the timeout
+    # anyway, or they'd be killed.
+    spawned_at = worker.tmp.last_update()
+    deadline = time.monotonic() + server.timeout
+    while time.monotonic() < deadline:
+        # The worker is removed when it is reaped (on SIGCHLD)
+        if pid not in server.WORKERS:
+            return
+        if worker.tmp.last_update() != spawned_at:
+            return
+        time.sleep(0.1)
+
+    server.log.warning(
+        "Worker with pid %s not ready after %ss, continuing reload anyway",
+        pid, server.timeout)
+
+
+def post_worker_init(worker):
+    # Called in the worker after the WSGI app is loaded but before the worker
+    # starts accepting requests.
+
+    # Gunicorn resets the worker's signal handlers after post_fork, so the
+    # stack dump handler is installed here instead
+    if SLOW_REQUEST_TIMEOUT and WORKER_PROFILE == "sync":
+        from django_bootstrap import slow
+        slow.install(SLOW_REQUEST_SIGNAL)
+
+    if WARMUP:
+        _warm_up(worker)
+
+    # Every worker starts the thread, but only one at a time runs the checks
+    if HEALTH_CHECK_INTERVAL and "DJANGO_SETTINGS_MODULE" in os.environ:
+        from django_bootstrap import health
+        health.start(HEALTH_CHECK_INTERVAL, worker.log)
+
+    _update_state(worker_ready=worker.pid)
+
+
+def _warm_up(worker):
+    # Do all the things that Django does lazily on the first requests, so that
+    # those requests aren't slow.
+    if "DJANGO_SETTINGS_MODULE" in os.environ:
+        try:
+            _warm_up_django(worker)
+        except Exception:
+            worker.log.warning("Unable to warm up Django", exc_info=True)
+
+    if WARMUP_URL:
+        try:
+            if WORKER_PROFILE == "asgi":
+                _warm_up_asgi_request(worker, WARMUP_URL)
+            else:
+                _warm_up_request(worker, WARMUP_URL)
+        except Exception:
+            worker.log.warning(
+                "Warmup request to '%s' failed", WARMUP_URL, exc_info=True)
+
+
+def _warm_up_django(worker):
+    from django.db import connections
+    from django.template import engines, loader
+    from django.urls import get_resolver
+
+    # Import all the URLconf modules and compile the URL patterns
+    get_resolver().reverse_dict
+
+    # Set up the template engines and their loaders, and compile templates
+    engines.all()
+    for template_name in WARMUP_TEMPLATES:
+        loader.get_template(template_name)
+
+    # Connect to the database(s). This is only useful if connections are
+    # persistent (i.e. CONN_MAX_AGE is set), otherwise Django will close the
+    # connection at the start of the first request.
+    for connection in connections.all():
+        connection.ensure_connection()
+
+
+def _warm_up_request(worker, url):
+    # Make a request to the WSGI app in-process--the request doesn't go
+    # through Nginx or the socket.
+    url = urlsplit(url)
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": url.path or "/",
+        "QUERY_STRING": url.query,
+        "SERVER_NAME": WARMUP_HOST,
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_HOST": WARMUP_HOST,
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+
+    response = worker.wsgi(environ, start_response)
+    try:
+        for _ in response:
+            pass
+    finally:
+        if hasattr(response, "close"):
+            response.close()
+
+    worker.log.info(
+        "Warmup request to '%s' returned '%s'", url.geturl(), statuses[-1])
+
+
+def _warm_up_asgi_request(worker, url):
+    # The same as _warm_up_request, for ASGI apps. Use a separate event loop
+    # so that the worker's own event loop isn't affected.
+    url = urlsplit(url)
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": url.path or "/",
+        "raw_path": (url.path or "/").encode(),
+        "query_string": url.query.encode(),
+        "root_path": "",
+        "headers": [(b"host", WARMUP_HOST.encode())],
+        "client": ("127.0.0.1", 0),
+        "server": (WARMUP_HOST, 80),
+    }
+
+    statuses = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(worker.wsgi(scope, receive, send))
+    finally:
+        loop.close()
+
+    worker.log.info(
+        "Warmup request to '%s' returned '%s'", url.geturl(), statuses[-1])
+
+
+# Whether the arbiter is shutting down
+_stopping = False
+
+
+def _draining(handler):
+    def handle():
+        global _stopping
+        _stopping = True
+        _update_state(draining=True)
+        handler()
+    return handle
+
+
+def _reap_workers(server):
+    """
+    Gunicorn 20.1's Arbiter.reap_workers(), except that the arbiter's other
+    children (see django_bootstrap.runtime.add_child()) are handled by
+    _child_exited() rather than treated as workers. Otherwise an exit code of
+    3 or 4 from one of them would halt the arbiter as if a worker failed to
+    boot, and any other exit would go unnoticed.
+    """
+    from django_bootstrap import runtime
+    children = runtime.children()
+    try:
+        while True:
+            wpid, status = os.waitpid(-1, os.WNOHANG)
+            if not wpid:
+                break
+            if wpid in children:
+                _child_exited(server, wpid, children[wpid], status)
+            elif server.reexec_pid == wpid:
+                server.reexec_pid = 0
+            else:
+                # A worker was terminated. If the termination reason was
+                # that it could not boot, we'll shut it down to avoid
+                # infinite start/stop cycles.
+                exitcode = status >> 8
+                if exitcode == server.WORKER_BOOT_ERROR:
+                    reason = "Worker failed to boot."
+                    raise HaltServer(reason, server.WORKER_BOOT_ERROR)
+                if exitcode == server.APP_LOAD_ERROR:
+                    reason = "App failed to load."
+                    raise HaltServer(reason, server.APP_LOAD_ERROR)
+                if os.WIFSIGNALED(status):
+                    server.log.warning(
+                        "Worker with pid %s was terminated due to signal %s",
+                        wpid, os.WTERMSIG(status))
+
+                worker = server.WORKERS.pop(wpid, None)
+                if not worker:
+                    continue
+                worker.tmp.close()
+                server.cfg.child_exit(server, worker)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+
+
+def _child_exited(server, pid, description, status):
+    global _stopping
+    # Celery writes Prometheus metrics files too, with SHARED_PRELOAD
+    _mark_process_dead(pid)
+
+    if os.WIFSIGNALED(status):
+        how = "was terminated due to signal {}".format(os.WTERMSIG(status))
+    else:
+        how = "exited with code {}".format(os.WEXITSTATUS(status))
+    if _stopping:
+        server.log.info("%s (pid:%s) %s", description, pid, how)
+        return
+
+    # Nothing would restart it, so stop the container deliberately rather
+    # than carry on without it, so that it is restarted
+    _stopping = True
+    server.log.error("%s (pid:%s) %s. Shutting down.", description, pid, how)
+    _update_state(draining=True)
+    raise HaltServer("{} exited.".format(description), 1)
+
+
+def _expiring_health_checks(server, murder_workers):
+    def check_workers():
+        from django_bootstrap import health
+        health.expire(HEALTH_CHECK_INTERVAL, server.log)
+        murder_workers()
+    return check_workers
+
+
+def _update_state(worker_ready=None, worker_stopped=None, draining=False):
+    """
+    Update the state files that Nginx serves for the /_ddb/live and
+    /_ddb/ready health checks. Each worker that is ready to accept requests
+    has a file in the workers directory. The ready file only exists if there
+    is at least one ready worker and Gunicorn isn't shutting down.
+    """
+    from django_bootstrap.runtime import STATE_DIR, write_json
+
+    # Only the default pool's workers count towards readiness
+    if POOL or not os.path.isdir(STATE_DIR):
+        return
+
+    workers_dir = os.path.join(STATE_DIR, "workers")
+    # Both the arbiter and the workers update the state, so take a lock
+    with open(os.path.join(STATE_DIR, "state.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if worker_ready is not None:
+            open(os.path.join(workers_dir, str(worker_ready)), "w").close()
+        if worker_stopped is not None:
+            try:
+                os.unlink(os.path.join(workers_dir, str(worker_stopped)))
+            except FileNotFoundError:
+                pass
+
+        state_path = os.path.join(STATE_DIR, "state.json")
+        try:
+            with open(state_path) as f:
+                draining = draining or json.load(f)["status"] == "draining"
+        except (OSError, ValueError, KeyError):
+            pass
+
+        workers = len(os.listdir(workers_dir))
+        if draining:
+            status = "draining"
+        elif workers > 0:
+            status = "ready"
+        else:
+            status = "starting"
+        state = {"status": status, "workers": workers}
+
+        ready_path = os.path.join(STATE_DIR, "ready.json")
+        write_json(state_path, state)
+        if status == "ready":
+            write_json(ready_path, state)
+        else:
+            try:
+                os.unlink(ready_path)
+            except FileNotFoundError:
+                pass
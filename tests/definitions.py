@@ -25,6 +25,9 @@ default_env = {
     'ALLOWED_HOSTS': 'localhost,127.0.0.1,0.0.0.0',
     'CELERY_BROKER_URL': amqp_container.broker_url(),
     'DATABASE_URL': db_container.database_url(),
+    # Pin the number of Nginx workers so that the processes are predictable
+    # no matter how many CPUs the test machine has
+    'NGINX_WORKER_PROCESSES': '1',
 }
 
 
@@ -0,0 +1,47 @@
+"""
+A minimal ASGI app for testing the ASGI worker profile. Django 2.2 doesn't
+support ASGI, so this doesn't use Django. With Django 3.0+, this would be:
+
+    from django.core.asgi import get_asgi_application
+
+    application = get_asgi_application()
+"""
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    elif scope['type'] == 'http':
+        # Respond with the scheme so that we can check that the
+        # X-Forwarded-Proto header is used
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/plain')],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': scope['scheme'].encode(),
+        })
+
+    elif scope['type'] == 'websocket':
+        # Echo messages back to the client
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.connect':
+                await send({'type': 'websocket.accept'})
+            elif message['type'] == 'websocket.receive':
+                await send({
+                    'type': 'websocket.send',
+                    'text': message.get('text'),
+                    'bytes': message.get('bytes'),
+                })
+            elif message['type'] == 'websocket.disconnect':
+                return
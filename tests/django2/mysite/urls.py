@@ -18,9 +18,15 @@ from django.urls import include, path
 
 import django_prometheus
 
+from . import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('health/', include('health_check.urls')),
     path('metrics/', django_prometheus.exports.ExportToDjangoView,
          name='prometheus-django-metrics'),
+    path('protected/<path:name>', views.protected_file),
+    path('scheme/', views.scheme),
+    path('sleep/', views.sleep),
+    path('shared-counter/', views.shared_counter),
 ]
@@ -0,0 +1,30 @@
+import os
+import time
+
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from django_bootstrap.media import protected_media_response
+
+
+def protected_file(request, name):
+    # A real project would check that the user may access the file here
+    return protected_media_response(name, as_attachment=True)
+
+
+def scheme(request):
+    return HttpResponse(request.scheme, content_type='text/plain')
+
+
+def sleep(request):
+    time.sleep(float(request.GET.get('seconds', '0.1')))
+    return HttpResponse('', content_type='text/plain')
+
+
+def shared_counter(request):
+    # Count requests across all the workers
+    cache = caches['shared']
+    cache.add('counter', 0)
+    count = cache.incr('counter')
+    return HttpResponse(
+        '{} {}'.format(count, os.getpid()), content_type='text/plain')
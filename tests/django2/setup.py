@@ -13,6 +13,11 @@ setup(
         'django-environ',
         'django-health-check',
         'django-prometheus <2.3',
+        # For testing the gevent and asgi worker profiles
+        'gevent',
+        'psycogreen',
+        'uvicorn',
+        'websockets',
         'psycopg2-binary >=2.7',
         # For compat with older celery in Python 3.7
         'importlib_metadata < 5.0',
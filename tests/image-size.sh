@@ -0,0 +1,19 @@
+#!/usr/bin/env sh
+set -e
+
+# Print the size of an image and, if a budget is given, check that it isn't
+# larger than that. The size of the compressed layers is roughly what has to be
+# pulled onto a fresh node, which takes most of the time to start the first
+# container there.
+# Usage: image-size.sh IMAGE [MAX_COMPRESSED_MB]
+image="$1"
+max_mb="$2"
+
+size="$(docker image inspect --format '{{.Size}}' "$image")"
+compressed="$(docker save "$image" | gzip -c | wc -c)"
+echo "$image: $((size / 1048576))MB, $((compressed / 1048576))MB compressed"
+
+if [ -n "$max_mb" ] && [ "$compressed" -gt $((max_mb * 1048576)) ]; then
+  echo "$image is larger than the budget of ${max_mb}MB compressed" 1>&2
+  exit 1
+fi
@@ -2,7 +2,9 @@
 import json
 import logging
 import re
+import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 import iso8601
@@ -18,9 +20,10 @@ from seaworthy.utils import output_lines
 
 from testtools.assertions import assert_that
 from testtools.matchers import (
-    AfterPreprocessing as After, Contains, Equals, GreaterThan, HasLength,
-    LessThan, MatchesAll, MatchesAny, MatchesDict, MatchesListwise,
-    MatchesRegex, MatchesSetwise, Not, StartsWith)
+    AfterPreprocessing as After, AnyMatch, Contains, EndsWith, Equals,
+    GreaterThan, HasLength, IsInstance, LessThan, MatchesAll, MatchesAny,
+    MatchesDict, MatchesListwise, MatchesRegex, MatchesSetwise, Not,
+    StartsWith)
 
 from definitions import (  # noqa: I100,I101
     # dependencies
@@ -57,6 +60,33 @@ raw_amqp_fixture, amqp_fixture = amqp_container.pytest_clean_fixtures(
     'amqp_container', scope='module')
 
 
+# Make requests to Nginx from inside the container, as only port 8000 is
+# published in the tests. The self-signed certificate is generated in the
+# test image.
+TLS_CLIENT_SCRIPT = """
+import http.client
+import socket
+import ssl
+
+context = ssl.create_default_context(cafile='/etc/nginx/certs/tls.crt')
+context.set_alpn_protocols(['h2', 'http/1.1'])
+sock = socket.create_connection(('localhost', 8443))
+with context.wrap_socket(sock, server_hostname='localhost') as tls_sock:
+    print(tls_sock.selected_alpn_protocol())
+
+context = ssl.create_default_context(cafile='/etc/nginx/certs/tls.crt')
+headers = {'X-Forwarded-Proto': 'http'}
+conn = http.client.HTTPSConnection('localhost', 8443, context=context)
+conn.request('GET', '/scheme/', headers=headers)
+print(conn.getresponse().read().decode())
+
+headers = {'X-Forwarded-Proto': 'https'}
+conn = http.client.HTTPConnection('localhost', 8000)
+conn.request('GET', '/scheme/', headers=headers)
+print(conn.getresponse().read().decode())
+"""
+
+
 def public_tables(db_container):
     return [r[1] for r in db_container.list_tables() if r[0] == 'public']
 
@@ -173,6 +203,88 @@ class TestWeb(object):
                 ]),
             ]))
 
+    def test_expected_processes_shared_preload(
+            self, docker_helper, db_container, amqp_container):
+        """
+        When the single container is running with the `SHARED_PRELOAD`
+        environment variable set, the Celery worker and beat processes should
+        be forked from Gunicorn's master process, which imports the Django
+        project first. The Prometheus metrics from all the Gunicorn workers
+        should be collected.
+        """
+        single_container.set_helper(docker_helper)
+        with single_container.setup(environment={
+                'SHARED_PRELOAD': '1', 'WEB_CONCURRENCY': '2'}):
+            matcher = OrderedMatcher(*(RegexMatcher(r) for r in (
+                r'Booting worker',
+                r'Booting worker',
+            )))
+            single_container.wait_for_logs_matching(
+                matcher, single_container.wait_timeout)
+
+            ps_rows = single_container.list_processes()
+            ps_tree = build_process_tree(ps_rows)
+
+            tini_args = 'tini -- django-entrypoint.sh mysite.wsgi:application'
+            # All the Python processes are forks of the same process
+            preload_args = (
+                'python -m django_bootstrap.preload gunicorn '
+                'mysite.wsgi:application --config /etc/gunicorn/config.py')
+            nginx_master_args = 'nginx: master process nginx -g daemon off;'
+            nginx_worker_args = 'nginx: worker process'
+
+            assert_that(
+                ps_tree,
+                MatchesPsTree('root', tini_args, pid=1, children=[
+                    MatchesPsTree('django', preload_args, children=[
+                        # The Gunicorn workers, Celery worker, and Celery beat
+                        MatchesPsTree('django', preload_args),
+                        MatchesPsTree('django', preload_args),
+                        MatchesPsTree('django', preload_args),
+                        MatchesPsTree('django', preload_args),
+                        MatchesPsTree('root', nginx_master_args, children=[
+                            MatchesPsTree('nginx', nginx_worker_args),
+                        ]),
+                    ]),
+                ]))
+
+            client = single_container.http_client()
+            response = client.get('/_ddb/ready')
+            assert_that(response.status_code, Equals(200))
+
+            # The Prometheus client was imported with Django, before Gunicorn
+            # started, but the workers' metrics should still be shared
+            for _ in range(10):
+                response = client.get('/admin')
+                assert_that(response.status_code, Equals(200))
+            for i in range(10):
+                response = client.get('/metrics')
+                [admin_sample] = http_requests_total_for_view(
+                    response.text, view='admin:index')
+                assert_that(admin_sample.value, Equals(10.0))
+                [metrics_sample] = http_requests_total_for_view(
+                    response.text, 'prometheus-django-metrics')
+                assert_that(metrics_sample.value, Equals(i + 1))
+
+    def test_shared_preload_celery_exit(
+            self, docker_helper, db_container, amqp_container):
+        """
+        When the single container is running with the `SHARED_PRELOAD`
+        environment variable set and a Celery process exits, Gunicorn's
+        arbiter should report it and shut down, rather than carry on without
+        it.
+        """
+        single_container.set_helper(docker_helper)
+        with single_container.setup(environment={'SHARED_PRELOAD': '1'}):
+            [pid] = single_container.exec_run(['cat', '/run/celery/worker.pid'])
+            single_container.exec_run(['kill', '-KILL', pid])
+
+            single_container.wait_for_logs_matching(RegexMatcher(
+                r'Celery worker \(pid:{}\) was terminated due to signal 9\. '
+                r'Shutting down\.'.format(pid)),
+                single_container.wait_timeout)
+            single_container.inner().wait(timeout=single_container.wait_timeout)
+
     def test_expected_files(self, web_only_container):
         """
         When the container is running, there should be PID files for Nginx and
@@ -290,6 +402,37 @@ class TestWeb(object):
         """
         assert_that(len(public_tables(db_container)), GreaterThan(0))
 
+    def test_dependency_wait(self, docker_helper, db_container):
+        """
+        When the web container is running with the `DEPENDENCY_WAIT_TIMEOUT`
+        environment variable set, the entrypoint should wait for the
+        database before running migrations, and give up on dependencies that
+        aren't available in time, or whose URLs are invalid.
+        """
+        web_container.set_helper(docker_helper)
+        # There's no broker for the web container alone
+        with web_container.setup(environment={
+                'DEPENDENCY_WAIT_TIMEOUT': '30', 'CELERY_BROKER_URL': ''}):
+            assert_that(public_tables(db_container), Contains('django_session'))
+
+            # The database is available, but nothing listens on port 1
+            output = web_container.exec_run(
+                ['python', '-m', 'django_bootstrap.wait'], environment={
+                    'DEPENDENCY_WAIT_TIMEOUT': '1',
+                    'CELERY_BROKER_URL': 'amqp://127.0.0.1:1//'})
+            assert_that(output, MatchesListwise([
+                StartsWith('Waiting for broker at 127.0.0.1:1: '),
+                Equals('Gave up waiting after 1s for: broker at '
+                       '127.0.0.1:1'),
+            ]))
+
+            output = web_container.exec_run(
+                ['python', '-m', 'django_bootstrap.wait'], environment={
+                    'DEPENDENCY_WAIT_TIMEOUT': '1',
+                    'CELERY_BROKER_URL': 'amqp://127.0.0.1:notaport//'})
+            assert_that(output, Equals(
+                ['$CELERY_BROKER_URL has an invalid port']))
+
     @pytest.mark.clean_db_container
     def test_database_tables_not_created(self, docker_helper, db_container):
         """
@@ -357,6 +500,23 @@ class TestWeb(object):
         assert_that(sample.labels['method'], Equals('GET'))
         assert_that(sample.value, Equals(1.0))
 
+    def test_prometheus_metrics_db_connections(self, web_container):
+        """
+        When we make several requests, the worker's database connection should
+        be reused, with only one connection opened.
+        """
+        web_client = web_container.http_client()
+        for _ in range(3):
+            response = web_client.get('/metrics')
+
+        fs = prom_parser.text_string_to_metric_families(response.text)
+        [family] = [f for f in fs
+                    if f.name == 'django_bootstrap_db_connections_opened']
+        [sample] = [s for s in family.samples if s.name.endswith('_total')]
+        assert_that(sample.labels, Equals(
+            {'alias': 'default', 'vendor': 'postgresql'}))
+        assert_that(sample.value, Equals(1.0))
+
     def test_prometheus_metrics_worker_restart(self, web_container):
         """
         When a worker process is restarted, Prometheus counters should be
@@ -389,6 +549,107 @@ class TestWeb(object):
             response.text, 'prometheus-django-metrics')
         assert_that(sample.value, Equals(2.0))
 
+    def test_prometheus_max_label_values(self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `PROMETHEUS_MAX_LABEL_VALUES` environment variable set, label values
+        beyond that many should be counted as "other", and the truncation
+        should be reported.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'WEB_CONCURRENCY': '1',
+                'PROMETHEUS_MAX_LABEL_VALUES': '2'}):
+            web_client = web_container.http_client()
+            web_client.get('/admin/login/')
+            web_client.get('/scheme/')
+            # A third view
+            response = web_client.get('/metrics')
+
+            [sample] = http_requests_total_for_view(response.text, 'other')
+            assert_that(sample.value, Equals(1.0))
+            assert_that(http_requests_total_for_view(
+                response.text, 'prometheus-django-metrics'), Equals([]))
+
+            fs = prom_parser.text_string_to_metric_families(response.text)
+            [family] = [f for f in fs if f.name == (
+                'django_bootstrap_metric_labels_truncated')]
+            samples = [s for s in family.samples if s.name.endswith('_total')]
+            assert_that([s.labels for s in samples], Contains({
+                'metric': 'django_http_requests_total_by_view_transport_method',
+                'label': 'view',
+            }))
+
+    def test_pgbouncer(self, docker_helper, db_container):
+        """
+        When the web container is running with the `RUN_PGBOUNCER`
+        environment variable set, PgBouncer should be running and Django
+        should connect to the database through it.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={'RUN_PGBOUNCER': '1'}):
+            stat = web_container.exec_stat(
+                '/run/pgbouncer', '/run/pgbouncer/.s.PGSQL.6432')
+            assert_that(stat, Equals([
+                '750 django:django',
+                '770 django:django',
+            ]))
+
+            ps_rows = web_container.list_processes()
+            assert_that([r.args for r in ps_rows], Contains(
+                'pgbouncer /run/pgbouncer/pgbouncer.ini'))
+
+            # The migrations metrics are collected from the database when the
+            # worker starts up
+            response = web_container.http_client().get('/metrics')
+            fs = prom_parser.text_string_to_metric_families(response.text)
+            [family] = [f for f in fs
+                        if f.name == 'django_migrations_applied_total']
+            assert_that(family.samples[0].value, GreaterThan(0))
+
+            # Gunicorn has the database URL for PgBouncer
+            gunicorns = [r for r in ps_rows
+                         if '/usr/local/bin/gunicorn' in r.args]
+            env = web_container.exec_run([
+                'sh', '-c', 'tr "\\0" "\\n" < /proc/{}/environ'.format(
+                    gunicorns[0].pid)
+            ], user='django')
+            [database_url] = [e for e in env if e.startswith('DATABASE_URL=')]
+            assert_that(database_url, Contains(
+                'host=%2Frun%2Fpgbouncer&port=6432'))
+
+    def test_rolling_reload(self, docker_helper, db_container):
+        """
+        When the web container is running with the `GUNICORN_ROLLING_RELOAD`
+        environment variable set and Gunicorn is reloaded, the workers should
+        be replaced one at a time and requests should be served throughout.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'WEB_CONCURRENCY': '2',
+                'GUNICORN_ROLLING_RELOAD': '1',
+                'GUNICORN_WARMUP_URL': '/health/'}):
+            client = web_container.http_client()
+
+            web_container.inner().kill('SIGHUP')
+
+            # Make requests for a while during the reload
+            statuses = []
+            for _ in range(30):
+                statuses.append(client.get('/admin/login/').status_code)
+                time.sleep(0.1)
+            assert_that(set(statuses), Equals({200}))
+
+            matcher = OrderedMatcher(*(RegexMatcher(r) for r in (
+                r'Hang up',
+                r'Warmup request to \'/health/\' returned \'200 OK\'',
+                r'Retiring worker',
+                r'Warmup request to \'/health/\' returned \'200 OK\'',
+                r'Retiring worker',
+            )))
+            web_container.wait_for_logs_matching(
+                matcher, web_container.wait_timeout)
+
     def test_prometheus_metrics_web_concurrency(
             self, docker_helper, db_container):
         """
@@ -451,6 +712,288 @@ class TestWeb(object):
                     pids.add(sample.labels['pid'])
                 assert_that(pids, HasLength(4))
 
+    def test_nginx_health_checks(self, web_container):
+        """
+        When the container is running, Nginx should respond to the liveness
+        and readiness health checks with the state of the Gunicorn workers.
+        """
+        web_client = web_container.http_client()
+
+        for path in ['/_ddb/live', '/_ddb/ready']:
+            response = web_client.get(path)
+            assert_that(response.status_code, Equals(200))
+            assert_that(response.headers['Content-Type'],
+                        Equals('application/json'))
+            assert_that(response.json(), Equals(
+                {'status': 'ready', 'workers': 1}))
+
+    def test_nginx_health_checks_not_ready(self, web_container):
+        """
+        When there are no ready Gunicorn workers, Nginx should respond to the
+        readiness health check with a 503 status code.
+        """
+        # Simulate the state with no ready workers
+        web_container.exec_run(['rm', '/run/ddb/ready.json'])
+
+        web_client = web_container.http_client()
+        response = web_client.get('/_ddb/ready')
+        assert_that(response.status_code, Equals(503))
+        assert_that(response.json(), Equals({'status': 'ready', 'workers': 1}))
+
+        response = web_client.get('/_ddb/live')
+        assert_that(response.status_code, Equals(200))
+
+    def test_nginx_deep_health_checks(self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `GUNICORN_HEALTH_CHECK_INTERVAL` environment variable set, Nginx
+        should respond to the deep health check with the results of the
+        checks that a Gunicorn worker runs in the background, until the
+        results stop being updated.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'WEB_CONCURRENCY': '2',
+                'GUNICORN_HEALTH_CHECK_INTERVAL': '1'}):
+            web_client = web_container.http_client()
+            for _ in range(10):
+                response = web_client.get('/_ddb/health')
+                if response.status_code == 200:
+                    break
+                time.sleep(1)
+
+            assert_that(response.status_code, Equals(200))
+            assert_that(response.headers['Content-Type'],
+                        Equals('application/json'))
+            assert_that(response.json(), MatchesDict({
+                'status': Equals('healthy'),
+                'checked': IsInstance(int),
+                'checks': Equals({'database:default': 'working'}),
+            }))
+
+            # Only one worker runs the checks
+            web_container.wait_for_logs_matching(
+                RegexMatcher(r'Running health checks every 1s'),
+                web_container.wait_timeout)
+            logs = output_lines(web_container.get_logs())
+            [line] = [line for line in logs if 'Running health checks' in line]
+
+            # When the worker running the checks is stuck, the results go
+            # stale and the check fails
+            [pid] = re.search(r'\[(\d+)\] \[INFO\]', line).groups()
+            web_container.exec_run(['kill', '-STOP', pid])
+            for _ in range(15):
+                response = web_client.get('/_ddb/health')
+                if response.status_code == 503:
+                    break
+                time.sleep(1)
+            assert_that(response.status_code, Equals(503))
+            assert_that(response.json()['status'], Equals('stale'))
+
+    def test_nginx_deep_health_checks_not_run(self, web_container):
+        """
+        When the deep health checks aren't enabled, Nginx should respond to
+        the deep health check with a 503 status code.
+        """
+        web_client = web_container.http_client()
+        response = web_client.get('/_ddb/health')
+        assert_that(response.status_code, Equals(503))
+
+    def test_nginx_worker_processes(self, docker_helper, db_container):
+        """
+        When the web container is running with the `NGINX_WORKER_PROCESSES`
+        environment variable set, that number of Nginx workers should be
+        running and the kernel should distribute connections between them.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'NGINX_WORKER_PROCESSES': '3',
+                'NGINX_WORKER_CONNECTIONS': '2048'}):
+            ps_rows = web_container.list_processes()
+            nginx_workers = [
+                r for r in ps_rows if r.args == 'nginx: worker process']
+            assert_that(nginx_workers, HasLength(3))
+
+            main_conf = web_container.exec_run(['cat', '/run/nginx/main.conf'])
+            assert_that(main_conf, Contains('worker_processes 3;'))
+            events_conf = web_container.exec_run(
+                ['cat', '/run/nginx/events.conf'])
+            assert_that(events_conf, Contains('worker_connections 2048;'))
+            listen_conf = web_container.exec_run(
+                ['cat', '/run/nginx/listen.conf'])
+            assert_that(listen_conf, Equals(['listen 8000 reuseport;']))
+
+            response = web_container.http_client().get('/_ddb/live')
+            assert_that(response.status_code, Equals(200))
+
+    def test_cpu_affinity(self, docker_helper, db_container):
+        """
+        When the web container is running with the `GUNICORN_CPU_AFFINITY`
+        and `NGINX_CPU_AFFINITY` environment variables set, the Gunicorn
+        worker and the Nginx worker should each be pinned to a different CPU,
+        if there are enough CPUs.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'GUNICORN_CPU_AFFINITY': '1',
+                'NGINX_CPU_AFFINITY': 'on',
+                'NGINX_WORKER_PROCESSES': '1'}):
+            [cpus] = web_container.exec_run(
+                ['python', '-c', 'import os; print(len(os.sched_getaffinity(0)))'])
+            main_conf = web_container.exec_run(['cat', '/run/nginx/main.conf'])
+
+            ps_rows = web_container.list_processes()
+            gunicorns = [
+                r for r in ps_rows if '/usr/local/bin/gunicorn' in r.args]
+            nginx_workers = [
+                r for r in ps_rows if r.args == 'nginx: worker process']
+            worker_cpus = [
+                web_container.exec_run([
+                    'sh', '-c', 'grep Cpus_allowed_list /proc/{}/status'.format(
+                        row.pid)])[0].split()[1]
+                for row in (gunicorns[-1], nginx_workers[0])]
+
+            if int(cpus) < 2:
+                assert_that(main_conf, Contains(
+                    '# Not enough CPUs to pin each worker to its own'))
+                assert_that(worker_cpus[0], Equals(worker_cpus[1]))
+            else:
+                affinity = [
+                    line for line in main_conf
+                    if line.startswith('worker_cpu_affinity')]
+                assert_that(affinity, MatchesListwise([
+                    MatchesRegex(r'worker_cpu_affinity [01]+;$')]))
+                assert_that(worker_cpus[0], MatchesRegex(r'\d+$'))
+                assert_that(worker_cpus[1], MatchesRegex(r'\d+$'))
+                assert_that(worker_cpus[0], Not(Equals(worker_cpus[1])))
+
+            response = web_container.http_client().get('/_ddb/live')
+            assert_that(response.status_code, Equals(200))
+
+    def test_shared_memory_cache(self, docker_helper, db_container):
+        """
+        When several Gunicorn workers use the shared memory cache backend,
+        they should all see the same cache.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={'WEB_CONCURRENCY': '4'}):
+            web_client = web_container.http_client()
+            counts = []
+            for _ in range(40):
+                response = web_client.get('/shared-counter/')
+                assert_that(response.status_code, Equals(200))
+                count, _ = response.text.split()
+                counts.append(int(count))
+
+            # Every request incremented the same counter
+            assert_that(counts, Equals(list(range(1, 41))))
+
+            cache_file = web_container.exec_run(
+                ['stat', '-c', '%U %s', '/run/gunicorn/django_cache'])
+            assert_that(cache_file, MatchesListwise([
+                StartsWith('django ')]))
+
+    @pytest.mark.parametrize('mode', ['capped', 'jemalloc'])
+    def test_malloc_mode(self, docker_helper, db_container, mode):
+        """
+        When the web container is running with the `MALLOC_MODE` environment
+        variable set, Gunicorn should use the chosen allocator settings and
+        its worker shouldn't use more memory than with the default allocator.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup():
+            _, default_rss = self._gunicorn_worker_memory(web_container)
+
+        with web_container.setup(environment={'MALLOC_MODE': mode}):
+            worker, rss = self._gunicorn_worker_memory(web_container)
+
+            if mode == 'jemalloc':
+                maps = web_container.exec_run(
+                    ['cat', '/proc/{}/maps'.format(worker.pid)], user='django')
+                assert_that(maps, AnyMatch(Contains('libjemalloc.so')))
+            else:
+                env = web_container.exec_run([
+                    'sh', '-c', 'tr "\\0" "\\n" < /proc/{}/environ'.format(
+                        worker.pid)
+                ], user='django')
+                assert_that(env, Contains('MALLOC_ARENA_MAX=2'))
+
+        # Allow for some noise between runs
+        assert_that(rss, LessThan(default_rss * 1.25))
+
+    def _gunicorn_worker_memory(self, container):
+        # Make some requests, then return the worker's process and its
+        # resident set size in kB
+        web_client = container.http_client()
+        for _ in range(50):
+            web_client.get('/admin/login/')
+            web_client.get('/metrics')
+
+        ps_rows = container.list_processes()
+        gunicorns = [r for r in ps_rows if '/usr/local/bin/gunicorn' in r.args]
+        worker = gunicorns[-1]
+        [rss] = container.exec_run(
+            ['grep', '^VmRSS:', '/proc/{}/status'.format(worker.pid)])
+        return worker, int(rss.split()[1])
+
+    def test_nginx_forwarded_proto(self, web_container):
+        """
+        When Nginx doesn't terminate TLS, the X-Forwarded-Proto header from
+        the load balancer should be passed on to Gunicorn.
+        """
+        web_client = web_container.http_client()
+        response = web_client.get(
+            '/scheme/', headers={'X-Forwarded-Proto': 'https'})
+        assert_that(response.text, Equals('https'))
+
+        response = web_client.get('/scheme/')
+        assert_that(response.text, Equals('http'))
+
+    def test_nginx_tls(self, docker_helper, db_container):
+        """
+        When the web container is running with the `NGINX_TLS` environment
+        variable set, Nginx should accept TLS connections on port 8443 and
+        offer HTTP/2. Django should know whether the client connection was
+        secure, regardless of the X-Forwarded-Proto header sent by the client.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={'NGINX_TLS': 'on'}):
+            [alpn_protocol, tls_scheme, plain_scheme] = (
+                web_container.exec_run(['python', '-c', TLS_CLIENT_SCRIPT]))
+
+            assert_that(alpn_protocol, Equals('h2'))
+            assert_that(tls_scheme, Equals('https'))
+            assert_that(plain_scheme, Equals('http'))
+
+    def test_nginx_request_body_too_large(self, web_container):
+        """
+        When a request with a body larger than 20MB is made, Nginx should
+        reject it.
+        """
+        web_client = web_container.http_client()
+        response = web_client.post('/upload/', data=b'a' * (21 * 1024 * 1024))
+
+        assert_that(response.status_code, Equals(413))
+
+    def test_nginx_streaming_upload(self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `NGINX_STREAMING_UPLOAD_PREFIX` environment variable set, requests
+        with large bodies to paths with that prefix should be passed to
+        Gunicorn.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'NGINX_STREAMING_UPLOAD_PREFIX': '/upload/'}):
+            web_client = web_container.http_client()
+            response = web_client.post(
+                '/upload/', data=b'a' * (21 * 1024 * 1024))
+
+            # Django responds (there is no view for this path)
+            assert_that(response.status_code, Equals(404))
+            assert_that(response.headers['Content-Type'],
+                        Equals('text/html'))
+
     def test_nginx_access_logs(self, web_container):
         """
         When a request has been made to the container, Nginx logs access logs
@@ -543,6 +1086,348 @@ class TestWeb(object):
             assert_that(gunicorn_lines, HasLength(1))
             assert_that(gunicorn_lines[0], Contains('"GET / HTTP/1.0"'))
 
+    def test_gunicorn_access_logs_json(self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `GUNICORN_ACCESS_LOG_FORMAT` environment variable set to "json",
+        Gunicorn access logs should be logged in the same JSON format as
+        Nginx's.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'GUNICORN_ACCESS_LOGS': '1',
+                'GUNICORN_ACCESS_LOG_FORMAT': 'json',
+                'NGINX_ACCESS_LOG': 'off'}):
+            new_lines = self._log_lines_for_requests(web_container, ['/'])
+
+            # Only Gunicorn's log line as Nginx's access log is disabled
+            assert_that(new_lines, HasLength(1))
+            log = json.loads(new_lines[0])
+            assert_that(log, MatchesDict({
+                'time': After(iso8601.parse_date, Not(Equals(None))),
+                'request': Equals('GET / HTTP/1.0'),
+                'status': Equals(404),
+                'body_bytes_sent': GreaterThan(0),
+                'request_time': LessThan(1.0),
+                'http_referer': Equals(''),
+                # Gunicorn's client is Nginx, over the Unix socket
+                'remote_addr': IsInstance(str),
+                'http_host': MatchesRegex(r'^127.0.0.1:\d{4,5}$'),
+                'http_user_agent': MatchesRegex(r'^python-requests/'),
+                'remote_user': Equals(''),
+                'http_via': Equals(''),
+                'http_x_forwarded_proto': Equals(''),
+                'http_x_forwarded_for': MatchesRegex(
+                    r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$'),
+            }))
+
+    def test_nginx_access_log_filtering(self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `NGINX_ACCESS_LOG_SKIP_PATHS` and `NGINX_STATIC_ACCESS_LOG`
+        environment variables set, Nginx should not log requests for those
+        paths or for static files.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'NGINX_ACCESS_LOG_SKIP_PATHS': '/health/,/metrics/',
+                'NGINX_STATIC_ACCESS_LOG': 'off'}):
+            new_lines = self._log_lines_for_requests(
+                web_container,
+                ['/health/', '/static/admin/css/base.css', '/'])
+
+            assert_that(new_lines, HasLength(1))
+            assert_that(json.loads(new_lines[0])['request'],
+                        Equals('GET / HTTP/1.1'))
+
+    def test_nginx_access_log_sampling(self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `NGINX_ACCESS_LOG_SAMPLE_2XX` environment variable set, Nginx should
+        log only that percentage of requests with 2xx responses, but all other
+        requests.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'NGINX_ACCESS_LOG_SAMPLE_2XX': '0'}):
+            new_lines = self._log_lines_for_requests(
+                web_container, ['/health/', '/static/admin/css/base.css', '/'])
+
+            assert_that(new_lines, HasLength(1))
+            assert_that(json.loads(new_lines[0])['status'], Equals(404))
+
+    def test_nginx_access_log_buffered(self, docker_helper, db_container):
+        """
+        When the web container is running with the `NGINX_ACCESS_LOG_BUFFER`
+        environment variable set, Nginx should buffer access logs and write
+        them out after the flush interval.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'NGINX_ACCESS_LOG_BUFFER': '4k',
+                'NGINX_ACCESS_LOG_FLUSH': '2s'}):
+            new_lines = self._log_lines_for_requests(web_container, ['/'])
+            assert_that(new_lines, HasLength(0))
+
+            time.sleep(3)
+            logs = output_lines(web_container.get_logs(stderr=False))
+            assert_that(logs[-1], Contains('"request": "GET / HTTP/1.1"'))
+
+    def _log_lines_for_requests(self, web_container, paths):
+        # Wait a little bit so that previous requests have been written to
+        # the log.
+        time.sleep(0.2)
+        before_lines = output_lines(web_container.get_logs(stderr=False))
+
+        web_client = web_container.http_client()
+        for path in paths:
+            web_client.get(path)
+
+        # Wait a little bit so that our requests have been written to the log.
+        time.sleep(0.2)
+        after_lines = output_lines(web_container.get_logs(stderr=False))
+        return after_lines[len(before_lines):]
+
+    def test_gunicorn_profiling_sampled(self, docker_helper, db_container):
+        """
+        When the web container is running with the `GUNICORN_PROFILE_RATE`
+        environment variable set to 1, every request should be profiled and
+        the profiles can be merged and rendered as a flame graph.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={'GUNICORN_PROFILE_RATE': '1'}):
+            response = web_container.http_client().get('/sleep/')
+            assert_that(response.status_code, Equals(200))
+
+            merged = web_container.exec_run(
+                ['python', '-m', 'django_bootstrap.profiling', 'merge'])
+            assert_that(merged, Not(HasLength(0)))
+            for line in merged:
+                assert_that(line, MatchesRegex(r'^GET /sleep/;.+ \d+$'))
+            assert_that(merged, AnyMatch(Contains(';mysite.views:sleep;')))
+
+            flamegraph = web_container.exec_run(
+                ['python', '-m', 'django_bootstrap.profiling', 'flamegraph'])
+            assert_that(flamegraph[0], StartsWith('<?xml'))
+            assert_that(flamegraph[-1], Equals('</svg>'))
+
+    def test_gunicorn_profiling_signed(self, docker_helper, db_container):
+        """
+        When the web container is running with the `GUNICORN_PROFILE_SECRET`
+        environment variable set, only requests with a valid signed
+        `X-DDB-Profile` header for the request's path should be profiled.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(
+                environment={'GUNICORN_PROFILE_SECRET': 'sekrit'}):
+            [header] = web_container.exec_run(
+                ['python', '-m', 'django_bootstrap.profiling', 'sign',
+                 '/sleep/', '60'])
+
+            web_client = web_container.http_client()
+            web_client.get('/sleep/')
+            web_client.get('/sleep/', headers={'X-DDB-Profile': 'bad.sig'})
+            web_client.get('/scheme/', headers={'X-DDB-Profile': header})
+            # A header value with non-ASCII characters is just invalid
+            response = web_client.get(
+                '/sleep/', headers={'X-DDB-Profile': '9999999999.\xe9'})
+            assert_that(response.status_code, Equals(200))
+            profiles = web_container.exec_run(
+                ['find', '/run/gunicorn', '-name', '*.folded'])
+            assert_that(profiles, HasLength(0))
+
+            web_client.get('/sleep/', headers={'X-DDB-Profile': header})
+            profiles = web_container.exec_run(
+                ['find', '/run/gunicorn', '-name', '*.folded'])
+            assert_that(profiles, MatchesListwise([EndsWith('.folded')]))
+
+    def test_gunicorn_profiling_verify_non_ascii(self, web_container):
+        """
+        A signed `X-DDB-Profile` header value with non-ASCII characters should
+        fail verification rather than raise an error.
+        """
+        output = web_container.exec_run([
+            'python', '-c',
+            'from django_bootstrap.profiling import verify; '
+            'print(verify("sekrit", "/sleep/", "9999999999.\\u00e9"))'])
+        assert_that(output, Equals(['False']))
+
+    def test_gunicorn_slow_requests(self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `GUNICORN_SLOW_REQUEST_TIMEOUT` environment variable set, the stack
+        of a worker handling a slow request should be logged and slow
+        requests should be counted by URL pattern.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(
+                environment={'GUNICORN_SLOW_REQUEST_TIMEOUT': '1'}):
+            web_client = web_container.http_client()
+            response = web_client.get('/sleep/', params={'seconds': '0'})
+            assert_that(response.status_code, Equals(200))
+            response = web_client.get('/sleep/', params={'seconds': '2.5'})
+            assert_that(response.status_code, Equals(200))
+
+            matcher = OrderedMatcher(*(RegexMatcher(r) for r in (
+                r'Slow request in worker with pid \d+, running for',
+                r'File ".*/mysite/views\.py", line \d+ in sleep',
+            )))
+            web_container.wait_for_logs_matching(
+                matcher, web_container.wait_timeout)
+
+            response = web_client.get('/metrics')
+            fs = prom_parser.text_string_to_metric_families(response.text)
+            [family] = [f for f in fs
+                        if f.name == 'django_bootstrap_slow_requests']
+            [sample] = [
+                s for s in family.samples if s.name.endswith('_total')]
+            assert_that(sample.labels, Equals({'path': 'sleep/'}))
+            assert_that(sample.value, Equals(1.0))
+
+    def test_gunicorn_pools(self, docker_helper, db_container):
+        """
+        When the web container is running with the `GUNICORN_POOLS`
+        environment variable set, each pool should have its own Gunicorn
+        arbiter and socket, and Nginx should pass requests for the pool's URL
+        prefixes to it, so that slow requests don't hold up other requests.
+        Options for the default pool shouldn't apply to the other pools.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'GUNICORN_CMD_ARGS': '--workers 2',
+                'GUNICORN_POOLS': 'slow',
+                'GUNICORN_POOL_SLOW_PREFIXES': '/sleep/',
+                'GUNICORN_POOL_SLOW_WORKERS': '1'}):
+            matcher = OrderedMatcher(*(RegexMatcher(r) for r in (
+                r'Booting worker',
+                r'Booting worker',
+                r'Booting worker',
+            )))
+            web_container.wait_for_logs_matching(
+                matcher, web_container.wait_timeout)
+            # Two arbiters, with 2 and 1 workers
+            gunicorns = [r for r in web_container.list_processes()
+                         if '/usr/local/bin/gunicorn' in r.args]
+            assert_that(gunicorns, HasLength(5))
+
+            sockets = web_container.exec_run(
+                ['find', '/run/gunicorn', '-type', 's'])
+            assert_that(sockets, MatchesSetwise(
+                Equals('/run/gunicorn/gunicorn.sock'),
+                Equals('/run/gunicorn/slow.sock')))
+
+            pools_conf = web_container.exec_run(
+                ['cat', '/run/nginx/pools.conf'])
+            assert_that(pools_conf, AnyMatch(
+                Contains('server unix:/run/gunicorn/slow.sock')))
+            assert_that(pools_conf, AnyMatch(
+                Equals('    "~^/sleep/" gunicorn_slow;')))
+
+            # The default pool's workers are free while the slow pool's only
+            # worker handles the slow request
+            web_client = web_container.http_client()
+            with ThreadPoolExecutor(1) as executor:
+                slow = executor.submit(
+                    web_client.get, '/sleep/', params={'seconds': '5'})
+                time.sleep(1)
+                started = time.monotonic()
+                response = web_client.get('/admin/login/')
+                assert_that(response.status_code, Equals(200))
+                assert_that(time.monotonic() - started, LessThan(3))
+                assert_that(slow.result().status_code, Equals(200))
+
+    def test_gunicorn_pool_exit(self, docker_helper, db_container):
+        """
+        When a worker pool's arbiter exits, the default pool's arbiter should
+        report it and shut down, rather than carry on with Nginx unable to
+        reach the pool.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'GUNICORN_POOLS': 'slow',
+                'GUNICORN_POOL_SLOW_PREFIXES': '/sleep/'}):
+            # Wait for both pools to start
+            web_container.wait_for_logs_matching(OrderedMatcher(
+                RegexMatcher(r'Booting worker'),
+                RegexMatcher(r'Booting worker'),
+            ), web_container.wait_timeout)
+            [pid] = web_container.exec_run(['cat', '/run/gunicorn/slow.pid'])
+            web_container.exec_run(['kill', '-KILL', pid])
+
+            web_container.wait_for_logs_matching(RegexMatcher(
+                r"Worker pool 'slow' \(pid:{}\) was terminated due to "
+                r"signal 9\. Shutting down\.".format(pid)),
+                web_container.wait_timeout)
+            web_container.inner().wait(timeout=web_container.wait_timeout)
+
+    @pytest.mark.parametrize('profile', ['gthread', 'gevent'])
+    def test_gunicorn_worker_profile(
+            self, docker_helper, db_container, profile):
+        """
+        When the web container is running with the `GUNICORN_WORKER_PROFILE`
+        environment variable set, Gunicorn should use that worker class and
+        Nginx should keep connections to Gunicorn open between requests.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'GUNICORN_WORKER_PROFILE': profile,
+                'GUNICORN_ACCESS_LOGS': '1'}):
+            assert_that(
+                output_lines(web_container.get_logs(stdout=False)),
+                Contains(MatchesRegex(
+                    r'.*Using worker: {}$'.format(profile))))
+
+            upstream_conf = web_container.exec_run(
+                ['cat', '/run/nginx/upstream_keepalive.conf'])
+            assert_that(upstream_conf, Equals(['keepalive 32;']))
+
+            response = web_container.http_client().get('/admin/')
+            assert_that(response.text,
+                        Contains('<title>Log in | Django site admin</title>'))
+
+            # Nginx proxies requests using HTTP/1.1 so that the connection
+            # can be kept alive
+            new_lines = self._log_lines_for_requests(web_container, ['/'])
+            gunicorn_lines = [
+                l for l in new_lines if not re.match(r'^\{ .+', l)]
+            assert_that(gunicorn_lines, HasLength(1))
+            assert_that(gunicorn_lines[0], Contains('"GET / HTTP/1.1"'))
+
+    def test_asgi(self, docker_helper, db_container):
+        """
+        When the web container is running with an ASGI app, Gunicorn should
+        use Uvicorn workers, the X-Forwarded-Proto header should still be
+        used, and Nginx should pass on WebSocket upgrade requests.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(command=['mysite.asgi:application']):
+            assert_that(
+                output_lines(web_container.get_logs(stdout=False)),
+                Contains(MatchesRegex(
+                    r'.*Using worker: uvicorn.workers.UvicornWorker$')))
+
+            web_client = web_container.http_client()
+            response = web_client.get('/')
+            assert_that(response.text, Equals('http'))
+            response = web_client.get(
+                '/', headers={'X-Forwarded-Proto': 'https'})
+            assert_that(response.text, Equals('https'))
+
+            host, port = web_container.get_host_port('8000')
+            with socket.create_connection((host, int(port))) as sock:
+                sock.sendall(
+                    b'GET /ws/ HTTP/1.1\r\n'
+                    b'Host: localhost\r\n'
+                    b'Upgrade: websocket\r\n'
+                    b'Connection: Upgrade\r\n'
+                    b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                    b'Sec-WebSocket-Version: 13\r\n'
+                    b'\r\n')
+                status_line = sock.recv(4096).split(b'\r\n')[0]
+
+            assert_that(status_line,
+                        Equals(b'HTTP/1.1 101 Switching Protocols'))
+
     def test_static_file(self, web_container):
         """
         When a static file is requested, Nginx should serve the file with the
@@ -572,6 +1457,98 @@ class TestWeb(object):
         assert_that(response.headers['Cache-Control'],
                     Equals('max-age=315360000, public, immutable'))
 
+    def test_collectstatic_incremental(self, web_container):
+        """
+        When static files are collected incrementally, the files should be
+        collected and post-processed the first time, producing the same
+        manifest as collectstatic, and nothing should be done the second time.
+        """
+        collect = ['python', '-m', 'django_bootstrap.collectstatic']
+        manifest = ['cat', '/app/static/staticfiles.json']
+        before = json.loads('\n'.join(web_container.exec_run(manifest)))
+
+        output = web_container.exec_run(collect)
+        assert_that(output[-1], MatchesRegex(
+            r'^\d+ static files copied, \d+ unmodified, [1-9]\d* '
+            r'post-processed$'))
+        after = json.loads('\n'.join(web_container.exec_run(manifest)))
+        assert_that(after['paths'], Equals(before['paths']))
+
+        output = web_container.exec_run(collect)
+        assert_that(output[-1], MatchesRegex(r'^\d+ static files unchanged$'))
+
+    def test_collectstatic_at_startup_static_files_map(
+            self, docker_helper, db_container):
+        """
+        When the web container is running with the `RUN_COLLECTSTATIC`
+        environment variable set, the Nginx map of immutable static files
+        should be regenerated after the static files are collected.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(
+                environment={'RUN_COLLECTSTATIC': 'incremental'}):
+            web_container.wait_for_logs_matching(OrderedMatcher(
+                RegexMatcher(r'^\d+ static files '),
+                RegexMatcher(r'^Wrote \d+ static file URLs to '
+                             r'/etc/nginx/conf\.d/django\.conf\.d/maps/'
+                             r'static_files\.conf$'),
+            ), web_container.wait_timeout)
+
+            staticfiles = json.loads('\n'.join(web_container.exec_run(
+                ['cat', '/app/static/staticfiles.json'])))
+            hashed_css = staticfiles['paths']['admin/css/base.css']
+            response = web_container.http_client().get(
+                '/static/{}'.format(hashed_css))
+            assert_that(response.headers['Cache-Control'],
+                        Equals('max-age=315360000, public, immutable'))
+
+    def test_static_files_map(self, web_container):
+        """
+        The Nginx map of immutable static files should have been generated
+        from the static file manifests, and include files processed by both
+        ManifestStaticFilesStorage and django-compressor.
+        """
+        static_files_map = '\n'.join(web_container.exec_run([
+            'cat', '/etc/nginx/conf.d/django.conf.d/maps/static_files.conf']))
+        staticfiles = json.loads('\n'.join(web_container.exec_run(
+            ['cat', '/app/static/staticfiles.json'])))
+
+        hashed_css = staticfiles['paths']['admin/css/base.css']
+        assert_that(static_files_map,
+                    Contains('"/static/{}" 1;'.format(hashed_css)))
+        assert_that(static_files_map, Contains('"/static/CACHE/js/'))
+        assert_that(static_files_map, Not(Contains('"~')))
+
+    def test_static_immutable_validators_off(
+            self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `NGINX_STATIC_IMMUTABLE_VALIDATORS` environment variable set to
+        "off", Nginx should not send validators for immutable static files,
+        but should still send them for other static files.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'NGINX_STATIC_IMMUTABLE_VALIDATORS': 'off'}):
+            staticfiles = json.loads('\n'.join(web_container.exec_run(
+                ['cat', '/app/static/staticfiles.json'])))
+            hashed_css = staticfiles['paths']['admin/css/base.css']
+
+            web_client = web_container.http_client()
+            response = web_client.get('/static/' + hashed_css)
+            assert_that(response.status_code, Equals(200))
+            assert_that(response.headers['Cache-Control'],
+                        Equals('max-age=315360000, public, immutable'))
+            assert_that(response.headers, Not(Contains('ETag')))
+            assert_that(response.headers, Not(Contains('Last-Modified')))
+
+            response = web_client.get('/static/admin/css/base.css')
+            assert_that(response.status_code, Equals(200))
+            assert_that(response.headers['Cache-Control'],
+                        Equals('max-age=60, public'))
+            assert_that(response.headers, Contains('ETag'))
+            assert_that(response.headers, Contains('Last-Modified'))
+
     def test_django_compressor_js_file(self, web_container):
         """
         When a static JavaScript file that was processed by django_compressor
@@ -716,6 +1693,93 @@ class TestWeb(object):
 
         assert_that(app_media_ownership, Equals('django:django'))
 
+    def test_protected_media_file(self, web_container):
+        """
+        When a Django view responds with an X-Accel-Redirect header for a
+        protected media file, Nginx should send the file with the headers
+        from the view.
+        """
+        web_container.exec_run([
+            'sh', '-c', 'mkdir -p /app/protected/docs && '
+            'echo "Top secret" > /app/protected/docs/secret.txt'])
+
+        web_client = web_container.http_client()
+        response = web_client.get('/protected/docs/secret.txt')
+
+        assert_that(response.status_code, Equals(200))
+        assert_that(response.text, Equals('Top secret\n'))
+        assert_that(response.headers['Content-Type'], Equals('text/plain'))
+        assert_that(response.headers['Content-Disposition'],
+                    Equals('attachment; filename="secret.txt"'))
+        assert_that(response.headers['Cache-Control'], Equals('private'))
+        assert_that(response.headers, Not(Contains('X-Accel-Redirect')))
+
+    def test_protected_media_not_public(self, web_container):
+        """
+        Protected media files should not be served unless Django responds
+        with an X-Accel-Redirect header, and Django should not redirect to
+        files outside the protected media directory.
+        """
+        web_container.exec_run([
+            'sh', '-c', 'mkdir -p /app/protected/docs && '
+            'echo "Top secret" > /app/protected/docs/secret.txt'])
+
+        web_client = web_container.http_client()
+        response = web_client.get('/_ddb/protected/docs/secret.txt')
+        assert_that(response.status_code, Equals(404))
+
+        response = web_client.get('/protected/docs/..%2F..%2Fmanage.py')
+        assert_that(response.status_code, Equals(400))
+
+    def test_resized_media_image(self, docker_helper, db_container):
+        """
+        When the web container is running with the
+        `NGINX_MEDIA_RESIZE_SECRET` environment variable set, Nginx should
+        resize media images requested with a signed URL, and cache the
+        resized images.
+        """
+        web_container.set_helper(docker_helper)
+        with web_container.setup(environment={
+                'NGINX_MEDIA_RESIZE_SECRET': 'secret'}):
+            # Write a 40x20 PNG image
+            web_container.exec_run(['python', '-c', (
+                'import struct, zlib\n'
+                'def chunk(kind, data):\n'
+                '    body = kind + data\n'
+                '    return (struct.pack(">I", len(data)) + body +\n'
+                '            struct.pack(">I", zlib.crc32(body)))\n'
+                'rows = b"".join(b"\\0" + b"\\xff\\0\\0" * 40 '
+                'for _ in range(20))\n'
+                'with open("/app/media/red.png", "wb") as f:\n'
+                '    f.write(b"\\x89PNG\\r\\n\\x1a\\n" +\n'
+                '            chunk(b"IHDR", struct.pack(">IIBBBBB", '
+                '40, 20, 8, 2, 0, 0, 0)) +\n'
+                '            chunk(b"IDAT", zlib.compress(rows)) +\n'
+                '            chunk(b"IEND", b""))\n')])
+            [url] = web_container.exec_run([
+                'python', '-c',
+                'from django_bootstrap.media import resized_media_url; '
+                'print(resized_media_url("red.png", 10))'])
+            assert_that(url, StartsWith('/media-resized/resize/10x-/red.png?s='))
+
+            web_client = web_container.http_client()
+            for cache_status in ['MISS', 'HIT']:
+                response = web_client.get(url)
+                assert_that(response.status_code, Equals(200))
+                assert_that(response.headers['Content-Type'],
+                            Equals('image/png'))
+                assert_that(response.headers['X-Cache-Status'],
+                            Equals(cache_status))
+                # The width and height from the PNG's header
+                size = (int.from_bytes(response.content[16:20], 'big'),
+                        int.from_bytes(response.content[20:24], 'big'))
+                assert_that(size, Equals((10, 5)))
+
+            # Unsigned sizes aren't served
+            response = web_client.get(
+                url.replace('/10x-/', '/20x-/'))
+            assert_that(response.status_code, Equals(403))
+
 
 class TestCeleryWorker(object):
     def test_expected_processes(self, worker_only_container):
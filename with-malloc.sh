@@ -0,0 +1,33 @@
+#!/usr/bin/env sh
+set -e
+
+# Run a command with the memory allocator settings chosen by $MALLOC_MODE:
+#   jemalloc: use jemalloc rather than glibc's malloc, by preloading it
+#   capped:   use glibc's malloc, but with fewer arenas and a fixed threshold
+#             for returning freed memory to the OS
+# Long-running, multithreaded Python processes can fragment glibc's per-thread
+# arenas so that their memory usage grows steadily.
+JEMALLOC=/usr/local/lib/libjemalloc.so
+
+case "$MALLOC_MODE" in
+  jemalloc)
+    if [ -e "$JEMALLOC" ]; then
+      export LD_PRELOAD="$JEMALLOC${LD_PRELOAD:+ $LD_PRELOAD}"
+    else
+      echo "MALLOC_MODE is 'jemalloc' but $JEMALLOC doesn't exist, using the default allocator" 1>&2
+    fi
+    ;;
+  capped)
+    export MALLOC_ARENA_MAX="${MALLOC_ARENA_MAX:-2}"
+    export MALLOC_TRIM_THRESHOLD_="${MALLOC_TRIM_THRESHOLD_:-131072}"
+    export MALLOC_MMAP_THRESHOLD_="${MALLOC_MMAP_THRESHOLD_:-131072}"
+    ;;
+  ''|default)
+    ;;
+  *)
+    echo "Unknown MALLOC_MODE '$MALLOC_MODE', must be one of: capped, default, jemalloc" 1>&2
+    exit 1
+    ;;
+esac
+
+exec "$@"